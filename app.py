@@ -14,13 +14,16 @@ import uuid
 import tempfile
 import shutil
 import logging
-from utils.document_processor import DocumentProcessor, process_document
-from utils.layer_manager import LayerManager
 import json
 from dotenv import load_dotenv
 import base64
 from schemas import UpdateLayerSchema, BatchProcessSchema, UploadFileSchema
-from extensions import init_extensions
+from extensions import init_extensions, db
+from utils.job_queue import JobQueue, register_job_commands
+from utils.blob_store import register_blob_commands
+from utils.layer_session import release_sessions
+from utils.lazy_import import preload
+from utils.db_pool import engine_options, REPLICA_BIND
 
 # Configure logging with more details
 logging.basicConfig(
@@ -36,7 +39,7 @@ def verify_db_connection(app):
         try:
             # Get database URL (mask password for logging)
             db_url = app.config['SQLALCHEMY_DATABASE_URI']
-            masked_url = db_url.replace(db_url.split(':')[2].split('@')[0], '****')
+            masked_url = db_url.replace(db_url.split(':')[2].split('@')[0], '****') if '@' in db_url else db_url
             logger.info(f"Attempting to connect to database: {masked_url}")
 
             # Test connection
@@ -45,15 +48,43 @@ def verify_db_connection(app):
             logger.info("Database connection successful!")
 
             # Get database info
-            result = db.session.execute(text('SELECT version();')).scalar()
-            logger.info(f"Database version: {result}")
+            version = '.'.join(str(part) for part in db.engine.dialect.server_version_info or ())
+            logger.info(f"Database version: {db.engine.dialect.name} {version}")
 
             return True
         except Exception as e:
             logger.error(f"Database connection failed: {str(e)}")
             return False
 
+def create_folders(app):
+    """Create the upload, cache and work directories the app writes to"""
+    for key in ('UPLOAD_FOLDER', 'TEMPLATE_UPLOAD_FOLDER', 'PARSE_CACHE_FOLDER', 'LAYER_SESSION_FOLDER', 'BLOB_FOLDER',
+                'CHUNKED_UPLOAD_FOLDER', 'SPILL_FOLDER', 'METRICS_FOLDER', 'PROFILE_FOLDER'):
+        os.makedirs(app.config[key], exist_ok=True)
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'exports'), exist_ok=True)
+
+def register_db_commands(app):
+    """Add the ``flask init-db`` command that checks the database and creates its tables."""
+    import click
+
+    @app.cli.command('init-db')
+    def init_db():
+        """Verify the database connection and create missing tables and folders."""
+        import models  # noqa: F401 - registers the tables
+        if not verify_db_connection(app):
+            raise click.ClickException('Database connection verification failed')
+        with app.app_context():
+            db.create_all()
+        create_folders(app)
+        click.echo('Database tables and folders initialized')
+
 def create_app():
+    """Build the Flask app without touching the database.
+
+    Creating tables and checking the connection is left to ``flask init-db``,
+    run once per deployment, so importing the app stays cheap for every web
+    worker and CLI script.
+    """
     # Load environment variables
     load_dotenv()
 
@@ -87,9 +118,45 @@ def create_app():
         
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Pool sizing, pre-ping, recycle and statement timeout (DB_POOL_* / DB_STATEMENT_TIMEOUT_MS)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_url)
+
+    # Optional read replica for listing queries
+    replica_url = os.getenv('DATABASE_REPLICA_URL')
+    if replica_url:
+        if replica_url.startswith("postgres://"):
+            replica_url = replica_url.replace("postgres://", "postgresql://", 1)
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: replica_url}
     app.config['UPLOAD_FOLDER'] = 'uploads'
     app.config['TEMPLATE_UPLOAD_FOLDER'] = os.path.join('uploads', 'user_templates')
-    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request size (and chunk size)
+    app.config['MAX_UPLOAD_SIZE'] = int(os.getenv('MAX_UPLOAD_SIZE', 4 * 1024 * 1024 * 1024))  # chunked uploads
+    app.config['CHUNKED_UPLOAD_FOLDER'] = os.path.join('uploads', 'partial')
+    app.config['PARSE_CACHE_FOLDER'] = os.path.join('uploads', 'cache')
+    app.config['PARSE_CACHE_MAX_BYTES'] = int(os.getenv('PARSE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    app.config['LAYER_SESSION_FOLDER'] = os.path.join('uploads', 'sessions')
+    app.config['LAYER_SESSION_MAX'] = int(os.getenv('LAYER_SESSION_MAX', 32))
+    app.config['EXPORT_WORKERS'] = int(os.getenv('EXPORT_WORKERS', os.cpu_count() or 1))
+    app.config['EXPORT_CACHE_MAX_BYTES'] = int(os.getenv('EXPORT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+    app.config['EXPORT_MAX_AGE'] = int(os.getenv('EXPORT_MAX_AGE', 3600))  # seconds browsers may reuse an export unchecked
+    # Let a fronting nginx or Apache send export files (X-Sendfile) instead of the worker
+    app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+    app.config['BLOB_FOLDER'] = os.path.join('uploads', 'blobs')
+    app.config['JOB_QUEUE_PATH'] = os.path.join('uploads', 'jobs.sqlite3')
+    # Job workers started beside the web server by gunicorn's master or `python app.py`
+    app.config['JOB_EMBEDDED_WORKERS'] = int(os.getenv('JOB_EMBEDDED_WORKERS', 0))
+    app.config['PREVIEW_TILE_SIZE'] = 256
+    app.config['PREVIEW_MAX_TILES'] = int(os.getenv('PREVIEW_MAX_TILES', 2048))
+    app.config['JOB_LEASE_SECONDS'] = int(os.getenv('JOB_LEASE_SECONDS', 60))  # a job whose worker is silent this long is retried
+    app.config['JOB_MAX_ATTEMPTS'] = int(os.getenv('JOB_MAX_ATTEMPTS', 2))
+    app.config['JOB_MEMORY_LIMIT'] = int(os.getenv('JOB_MEMORY_LIMIT', 0))  # bytes of RSS per render, 0 = unlimited
+    app.config['SPILL_FOLDER'] = os.path.join('uploads', 'spill')
+    app.config['METRICS_FOLDER'] = os.path.join('uploads', 'metrics')
+    app.config['PROFILE_FOLDER'] = os.path.join('uploads', 'profiles')
+    app.config['PROFILER_TOKEN'] = os.getenv('PROFILER_TOKEN', '')  # empty disables the X-Profile header
+    app.config['PROFILER_INTERVAL'] = float(os.getenv('PROFILER_INTERVAL', 0.005))
+    # Import imaging libraries at startup, for servers that fork workers from a preloaded app
+    app.config['PRELOAD_MODULES'] = os.getenv('PRELOAD_MODULES', '').lower() in ('1', 'true', 'yes')
 
     # Initialize extensions in the correct order
     try:
@@ -99,12 +166,6 @@ def create_app():
         logger.info("Initializing extensions...")
         init_extensions(app)
         logger.info("Extensions initialized successfully")
-
-        # Verify database connection
-        if not verify_db_connection(app):
-            logger.error("Failed to verify database connection")
-            raise Exception("Database connection verification failed")
-        
     except Exception as e:
         logger.error(f"Error during initialization: {str(e)}")
         # Don't raise the error, let the app continue with reduced functionality
@@ -113,9 +174,7 @@ def create_app():
     # Create upload directories
     try:
         logger.info("Creating upload directories...")
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        os.makedirs(app.config['TEMPLATE_UPLOAD_FOLDER'], exist_ok=True)
-        os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'exports'), exist_ok=True)
+        create_folders(app)
         logger.info("Upload directories created successfully")
     except Exception as e:
         logger.error(f"Error creating directories: {str(e)}")
@@ -126,16 +185,17 @@ def create_app():
         # Import routes and models here to avoid circular imports
         from routes import register_routes
         register_routes(app)
-        
-        # Initialize database
-        try:
-            logger.info("Initializing database tables...")
-            db.create_all()
-            logger.info("Database tables initialized successfully")
-        except Exception as e:
-            logger.error(f"Database initialization failed: {str(e)}")
-            # Don't raise the error, let the app continue with reduced functionality
-            pass
+        register_job_commands(app)
+        register_blob_commands(app)
+        register_db_commands(app)
+    # Let idle layer sessions be evicted again once a request is done with them
+    app.teardown_appcontext(release_sessions)
+
+    if app.config['PRELOAD_MODULES']:
+        # Imported once here, the modules are shared copy-on-write by forked workers
+        logger.info("Preloading imaging modules...")
+        preload()
+        import utils.job_handlers  # noqa: F401 - registers the handlers
 
     return app
 
@@ -144,5 +204,8 @@ app = create_app()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    if app.config['JOB_EMBEDDED_WORKERS'] > 0:
+        # Forked before the server starts, while this process has no other threads
+        JobQueue.for_app(app).start_workers(app, app.config['JOB_EMBEDDED_WORKERS'])
     logger.info(f"Starting Flask application on port {port}")
     app.run(host='0.0.0.0', port=port) 
\ No newline at end of file
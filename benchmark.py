@@ -0,0 +1,252 @@
+"""Benchmark the document pipeline on synthetic PSDs.
+
+Generates PSDs of a given canvas size, layer count and text/pixel mix, then
+times parsing, smart cropping, text fitting, image adjustment and export.
+Each stage reports latency percentiles and its peak memory, measured in a
+second pass so that tracing allocations does not slow down the timed one.
+Results are written as JSON and can be compared against an earlier run:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from datetime import datetime
+import numpy as np
+from flask import Flask
+from PIL import Image, ImageDraw
+from psd_tools import PSDImage
+from psd_tools.api.layers import PixelLayer
+from psd_tools.constants import Tag
+
+from utils.document_processor import DocumentProcessor
+from utils.layer_manager import LayerManager
+from utils.memory_budget import MemoryBudget
+from utils.render_cache import LayerRenderCache
+
+WORDS = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore'.split()
+
+def make_psd(path, width, height, layers, text_ratio, seed=0):
+    """Write a synthetic PSD and return the ids of the layers that stand in for text.
+
+    psd-tools cannot author type layers, so text layers are pixel layers
+    that the benchmark turns into text layers once the document is loaded.
+    """
+    rng = random.Random(seed)
+    psd = PSDImage.new('RGBA', (width, height))
+    text_ids = set()
+    for index in range(layers):
+        layer_width = rng.randint(width // 8, width // 2)
+        layer_height = rng.randint(height // 8, height // 2)
+        image = Image.new('RGBA', (layer_width, layer_height), tuple(rng.randrange(256) for _ in range(3)) + (255,))
+        draw = ImageDraw.Draw(image)
+        # A few shapes give the saliency map something to find
+        for _ in range(4):
+            x, y = rng.randrange(layer_width), rng.randrange(layer_height)
+            draw.ellipse((x, y, x + layer_width // 4, y + layer_height // 4), fill=tuple(rng.randrange(256) for _ in range(3)) + (255,))
+        layer = PixelLayer.frompil(
+            image, psd, f'Layer {index}',
+            top=rng.randrange(height - layer_height + 1),
+            left=rng.randrange(width - layer_width + 1)
+        )
+        layer.tagged_blocks.set_data(Tag.LAYER_ID, index + 1)
+        psd.append(layer)
+        if rng.random() < text_ratio:
+            text_ids.add(str(index + 1))
+    psd.save(path)
+    return text_ids
+
+class PeakMemory:
+    """Track peak RSS growth and peak traced Python allocations over a block."""
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_traced = 0
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, MemoryBudget.rss() - self._baseline)
+
+    def __enter__(self):
+        self._baseline = MemoryBudget.rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        tracemalloc.start()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, MemoryBudget.rss() - self._baseline)
+        self.peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+def summarize(latencies, memory):
+    """Latency percentiles in milliseconds plus peak memory in MB."""
+    values = np.asarray(latencies) * 1000
+    return {
+        'count': len(latencies),
+        'mean_ms': round(float(values.mean()), 3),
+        'min_ms': round(float(values.min()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p90_ms': round(float(np.percentile(values, 90)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'max_ms': round(float(values.max()), 3),
+        'peak_rss_mb': round(memory.peak_rss / 2 ** 20, 2),
+        'peak_traced_mb': round(memory.peak_traced / 2 ** 20, 2)
+    }
+
+def measure(func, calls):
+    """Time ``func(*args)`` for every args tuple in ``calls``, then run them again for peak memory."""
+    latencies = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    with PeakMemory() as memory:
+        for args in calls:
+            func(*args)
+    return summarize(latencies, memory)
+
+def bench_document(app, path, text_ids, repeat, export_sizes):
+    results = {}
+    results['process_psd'] = measure(DocumentProcessor._process_psd, [(path,)] * repeat)
+
+    manager = LayerManager(f'bench-{os.path.basename(path)}')
+    manager.load_document(path)
+    layers = list(manager._layers.values())
+    rng = random.Random(1)
+    for layer in layers:
+        if layer['id'] in text_ids:
+            layer.update(type='text', text=' '.join(rng.choices(WORDS, k=rng.randint(3, 30))), size=rng.randint(24, 96))
+    text_layers = [layer for layer in layers if layer['type'] == 'text']
+    image_layers = [layer for layer in layers if layer['type'] == 'image']
+
+    sources = [manager._rasterizer.get_image(layer['id']) for layer in image_layers]
+    results['smart_crop_image'] = measure(DocumentProcessor.smart_crop_image, [
+        (image, (max(1, image.width * 2 // 3), max(1, image.height // 2)))
+        for image in sources for _ in range(repeat)
+    ])
+    if text_layers:
+        results['adjust_text_layer'] = measure(LayerManager._adjust_text_layer, [
+            (layer,) for layer in text_layers for _ in range(repeat)
+        ])
+    results['adjust_image_layer'] = measure(manager._adjust_image_layer, [
+        (layer,) for layer in image_layers for _ in range(repeat)
+    ])
+
+    def export_uncached(size, cold):
+        if cold:
+            # As after loading or editing every layer: nothing prepared or composited yet
+            manager.session.render_cache = LayerRenderCache()
+        # Remove the export again so every call renders instead of hitting the export cache
+        os.remove(_check(manager.export_document(size))['path'])
+
+    for size in export_sizes:
+        results[f'export_document[{size}]'] = measure(export_uncached, [(size, True)] * repeat)
+        # Re-exporting an unchanged session reuses its prepared layers and backgrounds
+        results[f'export_document_warm[{size}]'] = measure(export_uncached, [(size, False)] * repeat)
+        _check(manager.export_document(size))
+        results[f'export_document_cached[{size}]'] = measure(
+            lambda size=size: _check(manager.export_document(size)), [()] * repeat
+        )
+    return results
+
+def _check(result):
+    if not result.get('success'):
+        raise RuntimeError(result.get('error') or result.get('message'))
+    return result
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(current, baseline, threshold):
+    """Print the p50 change of every benchmark and return the regressed ones."""
+    regressions = []
+    for case, stages in current['results'].items():
+        for stage, stats in stages.items():
+            before = baseline.get('results', {}).get(case, {}).get(stage)
+            if not before or not before['p50_ms']:
+                continue
+            change = stats['p50_ms'] / before['p50_ms'] - 1
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append(f'{case} {stage}')
+            print(f"{case:<24} {stage:<28} {before['p50_ms']:>10.2f} -> {stats['p50_ms']:>10.2f} ms  {change:+7.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1000x1000,4000x3000', help='Canvas sizes to generate, e.g. 1000x1000,4000x3000')
+    parser.add_argument('--layers', default='10,50', help='Layer counts to generate')
+    parser.add_argument('--text-ratio', type=float, default=0.3, help='Share of layers that are text')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions per measured call')
+    parser.add_argument('--export-sizes', default='square', help='Export sizes to time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=f'benchmark_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    parser.add_argument('--compare', help='Earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Relative p50 slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    app = Flask(__name__)
+    app.config['UPLOAD_FOLDER'] = work_dir
+
+    report = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)
+        },
+        'results': {}
+    }
+    try:
+        with app.app_context():
+            for size in args.sizes.split(','):
+                width, height = (int(value) for value in size.lower().split('x'))
+                for layers in (int(value) for value in args.layers.split(',')):
+                    case = f'{width}x{height}_{layers}layers'
+                    path = os.path.join(work_dir, f'{case}.psd')
+                    text_ids = make_psd(path, width, height, layers, args.text_ratio, args.seed)
+                    print(f'Running {case}...', file=sys.stderr)
+                    report['results'][case] = bench_document(app, path, text_ids, args.repeat, args.export_sizes.split(','))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) above {args.threshold:.0%}', file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
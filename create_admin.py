@@ -1,4 +1,6 @@
-from app import db, User
+from app import app
+from extensions import db
+from models import User
 from werkzeug.security import generate_password_hash
 
 def create_admin_account():
@@ -21,4 +23,5 @@ def create_admin_account():
         print("Admin account already exists!")
 
 if __name__ == '__main__':
-    create_admin_account() 
\ No newline at end of file
+    with app.app_context():
+        create_admin_account()
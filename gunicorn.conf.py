@@ -0,0 +1,71 @@
+"""Gunicorn settings, picked up automatically when gunicorn runs from this directory.
+
+``SERVER_MODE`` picks how each worker process serves requests:
+
+* ``sync`` (default): one request at a time.
+* ``threaded``: ``GUNICORN_THREADS`` requests at a time on OS threads.
+* ``async``: gevent greenlets, up to ``GUNICORN_WORKER_CONNECTIONS`` open
+  connections each. Slow uploads, downloads and status polling only cost a
+  greenlet; CPU-bound rendering is handed to ``OFFLOAD_THREADS`` native
+  threads (see ``utils.offload``) while parsing and exports keep running in
+  the job worker processes.
+
+With ``PRELOAD_MODULES=1`` the app and its imaging libraries are imported
+once in the master process and shared copy-on-write by the forked workers,
+so a worker boots in milliseconds instead of importing everything itself.
+Preloading is skipped in async mode, where the app must be imported after
+gevent has patched the standard library.
+
+With ``JOB_EMBEDDED_WORKERS`` above 0, the master also runs that many job
+workers in a ``flask jobs-worker`` process, so a single container serves
+requests and background jobs. They are never forked from a web worker.
+"""
+import os
+import sys
+import subprocess
+
+server_mode = os.getenv('SERVER_MODE', 'sync')
+if server_mode == 'async':
+    worker_class = 'utils.gevent_worker.GeventWorker'
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+elif server_mode == 'threaded':
+    worker_class = 'gthread'
+    threads = int(os.getenv('GUNICORN_THREADS', 4 * (os.cpu_count() or 1)))
+
+preload_app = os.getenv('PRELOAD_MODULES', '').lower() in ('1', 'true', 'yes') and server_mode != 'async'
+
+def post_fork(server, worker):
+    """Give each forked worker its own database connections and metrics."""
+    if not preload_app:
+        return
+    from app import app
+    from extensions import db
+    from utils.metrics import metrics
+    metrics.reset()
+    with app.app_context():
+        # Connections opened in the master must not be shared across processes
+        db.engine.dispose()
+
+def when_ready(server):
+    """Start the embedded job workers once, beside the web workers."""
+    count = int(os.getenv('JOB_EMBEDDED_WORKERS', 0))
+    if count > 0:
+        # A separate process, so the master never imports the app before gevent patches it
+        server.job_workers = subprocess.Popen(
+            [sys.executable, '-m', 'flask', 'jobs-worker', '--workers', str(count)],
+            env={**os.environ, 'FLASK_APP': os.getenv('FLASK_APP', 'app')}
+        )
+
+def on_exit(server):
+    """Stop the embedded job workers with the server."""
+    process = getattr(server, 'job_workers', None)
+    if process is not None:
+        process.terminate()
+        process.wait()
+
+def post_worker_init(worker):
+    """Size the native thread pool that async workers offload CPU work to."""
+    if server_mode != 'async':
+        return
+    import gevent
+    gevent.get_hub().threadpool.maxsize = int(os.getenv('OFFLOAD_THREADS', os.cpu_count() or 1))
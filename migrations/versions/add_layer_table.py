@@ -0,0 +1,75 @@
+"""Add normalized layer table
+
+Revision ID: 2b3c4d5e6f7a
+Revises: 1a2b3c4d5e6f
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+import json
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2b3c4d5e6f7a'
+down_revision = '1a2b3c4d5e6f'
+branch_labels = None
+depends_on = None
+
+LAYER_COLUMNS = ('name', 'kind', 'type', 'visible', 'locked')
+LAYER_PIXEL_KEYS = ('content', 'processed_content')
+
+def upgrade():
+    layer_table = op.create_table('layer',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('project_file_id', sa.Integer(), nullable=False),
+        sa.Column('layer_id', sa.String(length=64), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=255), nullable=True),
+        sa.Column('kind', sa.String(length=50), nullable=True),
+        sa.Column('type', sa.String(length=50), nullable=True),
+        sa.Column('visible', sa.Boolean(), nullable=True),
+        sa.Column('locked', sa.Boolean(), nullable=True),
+        sa.Column('bounds', sa.Text(), nullable=True),
+        sa.Column('properties', sa.Text(), nullable=True),
+        sa.Column('content', sa.Text(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['project_file_id'], ['project_file.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_layer_project_file_layer', 'layer', ['project_file_id', 'layer_id'], unique=True)
+
+    # Copy layers out of the legacy ProjectFile.layers JSON blobs
+    project_file = sa.table('project_file',
+        sa.column('id', sa.Integer()),
+        sa.column('layers', sa.Text())
+    )
+    rows = []
+    for file_id, layers_json in op.get_bind().execute(sa.select(project_file.c.id, project_file.c.layers)):
+        try:
+            layers = json.loads(layers_json) if layers_json else []
+        except ValueError:
+            continue
+        if isinstance(layers, dict):
+            layers = list(layers.values())
+        for position, data in enumerate(layers):
+            if not isinstance(data, dict) or 'id' not in data:
+                continue
+            row = {key: data.get(key) for key in LAYER_COLUMNS}
+            row.update(
+                project_file_id=file_id,
+                layer_id=str(data['id']),
+                position=position,
+                bounds=json.dumps(data.get('bounds')),
+                properties=json.dumps({
+                    key: value for key, value in data.items()
+                    if key not in LAYER_COLUMNS and key not in LAYER_PIXEL_KEYS and key not in ('id', 'bounds')
+                }),
+                content=json.dumps({key: data[key] for key in LAYER_PIXEL_KEYS if key in data})
+            )
+            rows.append(row)
+    if rows:
+        op.bulk_insert(layer_table, rows)
+
+def downgrade():
+    op.drop_index('ix_layer_project_file_layer', table_name='layer')
+    op.drop_table('layer')
@@ -1,6 +1,10 @@
 from extensions import db
+import json
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import undefer
+from contextlib import nullcontext
+from utils.db_pool import read_session
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -31,4 +35,92 @@ class ProjectFile(db.Model):
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
     filepath = db.Column(db.String(200))
-    layers = db.Column(db.Text)  # JSON string of layer data 
\ No newline at end of file
+    layers = db.Column(db.Text)  # JSON string of layer data (legacy, superseded by Layer rows)
+
+# Layer keys stored in their own columns; everything else non-pixel goes in properties
+LAYER_COLUMNS = ('name', 'kind', 'type', 'visible', 'locked')
+# Layer keys holding (references to) pixel data, kept out of listing queries
+LAYER_PIXEL_KEYS = ('content', 'processed_content')
+
+class Layer(db.Model):
+    __table_args__ = (
+        db.Index('ix_layer_project_file_layer', 'project_file_id', 'layer_id', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_file_id = db.Column(db.Integer, db.ForeignKey('project_file.id'), nullable=False)
+    layer_id = db.Column(db.String(64), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    name = db.Column(db.String(255))
+    kind = db.Column(db.String(50))
+    type = db.Column(db.String(50))
+    visible = db.Column(db.Boolean, default=True)
+    locked = db.Column(db.Boolean, default=False)
+    bounds = db.Column(db.Text)  # JSON {x, y, width, height}
+    properties = db.Column(db.Text)  # JSON of text/font/size/color and other settings
+    content = db.deferred(db.Column(db.Text))  # JSON blob references, only loaded on access
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    project_file = db.relationship('ProjectFile', backref=db.backref('layer_records', lazy='dynamic'))
+
+    @staticmethod
+    def _split(data):
+        columns = {key: data[key] for key in LAYER_COLUMNS if key in data}
+        pixels = {key: data[key] for key in LAYER_PIXEL_KEYS if key in data}
+        properties = {
+            key: value for key, value in data.items()
+            if key not in LAYER_COLUMNS and key not in LAYER_PIXEL_KEYS and key not in ('id', 'bounds')
+        }
+        columns['bounds'] = json.dumps(data.get('bounds'))
+        columns['properties'] = json.dumps(properties)
+        columns['content'] = json.dumps(pixels)
+        return columns
+
+    @classmethod
+    def bulk_create(cls, project_file_id, layers):
+        """Insert all layers of a parsed document in one statement."""
+        mappings = []
+        for position, data in enumerate(layers):
+            mapping = cls._split(data)
+            mapping.update(project_file_id=project_file_id, layer_id=str(data['id']), position=position)
+            mappings.append(mapping)
+        db.session.bulk_insert_mappings(cls, mappings)
+
+    @classmethod
+    def list_for_file(cls, project_file_id, include_pixels=False, replica=False, project_id=None):
+        """Return a file's layers in z-order with a single query.
+
+        Pixel references are only selected when ``include_pixels`` is set.
+        With ``replica`` the query may go to the read replica, whose rows can
+        lag slightly behind the primary's. With ``project_id`` nothing is
+        returned unless the file belongs to that project.
+        """
+        with read_session(db) if replica else nullcontext(db.session) as session:
+            query = session.query(cls).filter_by(project_file_id=project_file_id).order_by(cls.position)
+            if project_id is not None:
+                query = query.join(ProjectFile, ProjectFile.id == cls.project_file_id).filter(ProjectFile.project_id == project_id)
+            if include_pixels:
+                query = query.options(undefer(cls.content))
+            return query.all()
+
+    @classmethod
+    def get_for_file(cls, project_file_id, layer_id):
+        return cls.query.filter_by(project_file_id=project_file_id, layer_id=str(layer_id)).first()
+
+    @classmethod
+    def last_updated(cls, project_file_id):
+        """Return when any of a file's layers last changed, or None if it has none."""
+        return db.session.query(db.func.max(cls.updated_at)).filter_by(project_file_id=project_file_id).scalar()
+
+    def update_from_dict(self, data):
+        """Overwrite this row with a layer dict, as produced by LayerManager."""
+        for key, value in self._split(data).items():
+            setattr(self, key, value)
+
+    def to_dict(self, include_pixels=False):
+        data = json.loads(self.properties or '{}')
+        data.update({key: getattr(self, key) for key in LAYER_COLUMNS})
+        data['id'] = self.layer_id
+        data['bounds'] = json.loads(self.bounds) if self.bounds else None
+        if include_pixels:
+            data.update(json.loads(self.content or '{}'))
+        return data
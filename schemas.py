@@ -1,4 +1,12 @@
-from marshmallow import Schema, fields, ValidationError
+from marshmallow import Schema, fields, validate, ValidationError, validates_schema
+from utils.encoders import Encoder, EncoderError
+
+def validate_encoders(specs):
+    """Reject output formats and encoder settings ``Encoder`` does not support."""
+    try:
+        Encoder.from_specs(specs)
+    except EncoderError as e:
+        raise ValidationError(str(e))
 
 class UpdateLayerSchema(Schema):
     project_id = fields.Int(required=True)
@@ -8,7 +16,25 @@ class UpdateLayerSchema(Schema):
     layer_type = fields.Str(required=True)
 
 class BatchProcessSchema(Schema):
-    files = fields.List(fields.Field(), required=True)
+    files = fields.List(fields.Field())
+    project_id = fields.Int()
+    substitutions = fields.List(fields.Dict())
+    sizes = fields.List(fields.Raw(), load_default=lambda: ['square'])
+    formats = fields.List(fields.Raw(), load_default=lambda: ['png'], validate=validate_encoders)
+
+    @validates_schema
+    def validate_batch(self, data, **kwargs):
+        if not data.get('files') and not data.get('substitutions'):
+            raise ValidationError('Either files or substitutions is required.')
+        if data.get('substitutions') and 'project_id' not in data:
+            raise ValidationError('project_id is required for substitutions.', 'project_id')
+
+class VariantGenerationSchema(Schema):
+    project_id = fields.Int(required=True)
+    rows = fields.List(fields.Dict(), required=True, validate=validate.Length(min=1))
+    sizes = fields.List(fields.Raw(), load_default=lambda: ['square'])
+    formats = fields.List(fields.Raw(), load_default=lambda: ['png'], validate=validate_encoders)
+    output = fields.Str(load_default='zip', validate=validate.OneOf(['zip', 'directory']))
 
 class UploadFileSchema(Schema):
     file = fields.Field(required=True)
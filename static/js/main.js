@@ -6,25 +6,30 @@ document.addEventListener('DOMContentLoaded', () => {
     fileInput.addEventListener('change', handleFileUpload);
 });
 
+// The project and file whose layers are shown, which layer edits and exports name
+const currentDocument = { projectId: null, fileId: null };
+
 async function handleFileUpload(event) {
     const file = event.target.files[0];
     if (!file) return;
 
-    const formData = new FormData();
-    formData.append('file', file);
-
     try {
-        const response = await fetch('/upload', {
-            method: 'POST',
-            body: formData
-        });
+        // The page hosting the file input names the project the upload belongs to
+        const projectId = event.target.dataset.projectId;
+        const job = await uploadInChunks(file, projectId);
+        if (job.error) {
+            alert(job.error);
+            return;
+        }
 
-        const data = await response.json();
+        const data = await waitForJob(job.status_url);
         if (data.error) {
             alert(data.error);
             return;
         }
 
+        currentDocument.projectId = Number(projectId);
+        currentDocument.fileId = data.file_id;
         displayLayers(data.layers);
     } catch (error) {
         console.error('Error uploading file:', error);
@@ -32,6 +37,53 @@ async function handleFileUpload(event) {
     }
 }
 
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+
+async function uploadInChunks(file, projectId) {
+    // Resumable upload: the server writes each chunk straight to disk
+    const createResponse = await fetch('/uploads', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            filename: file.name,
+            size: file.size,
+            project_id: projectId
+        })
+    });
+    const upload = await createResponse.json();
+    if (upload.error) {
+        return upload;
+    }
+
+    let offset = upload.offset;
+    while (true) {
+        const response = await fetch(upload.chunk_url, {
+            method: 'PUT',
+            headers: {
+                'Upload-Offset': String(offset)
+            },
+            body: file.slice(offset, offset + UPLOAD_CHUNK_SIZE)
+        });
+        const data = await response.json();
+        if (data.job_id) {
+            // Parsing was queued, by this chunk or by an earlier attempt at it
+            return data;
+        }
+        if (response.status === 409 && data.offset !== null && data.offset !== undefined && data.offset < file.size) {
+            // Resume from wherever the server actually is, once an earlier attempt still in flight is done
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            offset = data.offset;
+            continue;
+        }
+        if (data.error) {
+            return data;
+        }
+        offset = data.offset;
+    }
+}
+
 function displayLayers(layers) {
     const layerList = document.getElementById('layerList');
     layerList.innerHTML = '';
@@ -49,16 +101,30 @@ function createLayerElement(layer) {
     const header = document.createElement('div');
     header.className = 'flex justify-between items-center mb-2';
     
+    const label = document.createElement('div');
+    label.className = 'flex items-center';
+    
+    if (layer.thumbnails && layer.thumbnails['64']) {
+        // Smallest pyramid level, so the list never loads full-resolution pixels
+        const thumbnail = document.createElement('img');
+        thumbnail.src = `/thumbnails/${layer.thumbnails['64']}`;
+        thumbnail.alt = '';
+        thumbnail.loading = 'lazy';
+        thumbnail.className = 'w-8 h-8 object-contain bg-gray-100 rounded mr-2';
+        label.appendChild(thumbnail);
+    }
+    
     const title = document.createElement('h3');
     title.className = 'font-semibold';
     title.textContent = layer.name;
+    label.appendChild(title);
     
     const lockButton = document.createElement('button');
     lockButton.className = 'text-gray-500 hover:text-gray-700';
     lockButton.innerHTML = layer.locked ? '🔒' : '🔓';
     lockButton.onclick = () => toggleLayerLock(layer.id);
     
-    header.appendChild(title);
+    header.appendChild(label);
     header.appendChild(lockButton);
     
     const content = document.createElement('div');
@@ -125,9 +191,11 @@ async function updateLayer(layerId, content, type) {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
+                project_id: currentDocument.projectId,
+                file_id: currentDocument.fileId,
                 layer_id: layerId,
                 content: content,
-                type: type
+                layer_type: type
             })
         });
 
@@ -176,12 +244,19 @@ async function exportDocument(size) {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
+                project_id: currentDocument.projectId,
                 size: size,
                 format: 'png'
             })
         });
 
-        const data = await response.json();
+        const job = await response.json();
+        if (job.error) {
+            alert(job.error);
+            return;
+        }
+
+        const data = await waitForJob(job.status_url);
         if (data.error) {
             alert(data.error);
             return;
@@ -189,13 +264,29 @@ async function exportDocument(size) {
 
         // Display the exported image
         const preview = document.getElementById('preview');
-        preview.innerHTML = `<img src="${data.path}" alt="Preview" class="max-w-full">`;
+        preview.innerHTML = `<img src="${data.exports[0].url}" alt="Preview" class="max-w-full">`;
     } catch (error) {
         console.error('Error exporting document:', error);
         alert('Error exporting document. Please try again.');
     }
 }
 
+async function waitForJob(statusUrl, interval = 500) {
+    // Poll a background job until it finishes, then fetch its result
+    while (true) {
+        const response = await fetch(statusUrl);
+        const job = await response.json();
+        if (job.error || job.status === 'failed') {
+            return { error: job.error || 'Job failed' };
+        }
+        if (job.status === 'finished') {
+            const result = await fetch(job.result_url);
+            return result.json();
+        }
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+}
+
 function toggleLayerLock(layerId) {
     // Implement layer locking functionality
     console.log('Toggle lock for layer:', layerId);
@@ -0,0 +1,22 @@
+import os
+import sys
+
+# Run from anywhere: the app's modules are imported from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The Flask app, with its database and upload folders under ``tmp_path``."""
+    # Upload folders are configured relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'app.db'}")
+    monkeypatch.setenv('JOB_EMBEDDED_WORKERS', '0')
+    from app import create_app
+    from extensions import db
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
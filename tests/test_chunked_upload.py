@@ -0,0 +1,108 @@
+import fcntl
+import hashlib
+import os
+from io import BytesIO
+
+import pytest
+
+from utils.chunked_upload import ChunkedUploadStore, UploadError
+
+DATA = bytes(range(256)) * 40
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkedUploadStore(str(tmp_path / 'partial'), str(tmp_path), max_size=len(DATA) * 2)
+
+def upload_all(store, data, chunk_size=1000):
+    state = store.create('doc.psd', len(data))
+    for offset in range(0, len(data), chunk_size):
+        state = store.append(state['upload_id'], offset, BytesIO(data[offset:offset + chunk_size]))
+    return state
+
+def test_chunks_assemble_into_file_named_by_hash(store):
+    state = upload_all(store, DATA)
+
+    digest = hashlib.sha256(DATA).hexdigest()
+    assert state['complete']
+    assert state['sha256'] == digest
+    assert os.path.basename(state['filepath']) == f'{digest}.psd'
+    with open(state['filepath'], 'rb') as f:
+        assert f.read() == DATA
+
+def test_wrong_offset_is_refused_with_the_offset_to_resume_from(store):
+    state = store.create('doc.psd', len(DATA))
+    store.append(state['upload_id'], 0, BytesIO(DATA[:1000]))
+
+    with pytest.raises(UploadError) as error:
+        store.append(state['upload_id'], 2000, BytesIO(DATA[2000:3000]))
+
+    assert error.value.status == 409
+    assert error.value.offset == 1000
+    assert store.status(state['upload_id'])['offset'] == 1000
+
+def test_resume_after_restart_hashes_what_is_already_on_disk(store):
+    upload_id = store.create('doc.psd', len(DATA))['upload_id']
+    store.append(upload_id, 0, BytesIO(DATA[:1500]))
+    # A new process has no running hash for the upload
+    ChunkedUploadStore._hashers.clear()
+
+    offset = store.status(upload_id)['offset']
+    state = store.append(upload_id, offset, BytesIO(DATA[offset:]))
+
+    assert state['sha256'] == hashlib.sha256(DATA).hexdigest()
+
+def test_stale_retry_does_not_rewind_upload(store):
+    upload_id = store.create('doc.psd', len(DATA))['upload_id']
+    store.append(upload_id, 0, BytesIO(DATA[:1000]))
+    store.append(upload_id, 1000, BytesIO(DATA[1000:1500]))
+    # A retry of the second chunk, whose first attempt did land
+    with pytest.raises(UploadError) as error:
+        store.append(upload_id, 1000, BytesIO(DATA[1000:1500]))
+    assert error.value.offset == 1500
+
+    state = store.append(upload_id, 1500, BytesIO(DATA[1500:]))
+    assert state['sha256'] == hashlib.sha256(DATA).hexdigest()
+
+def test_completed_upload_refuses_more_chunks(store):
+    state = upload_all(store, DATA)
+
+    with pytest.raises(UploadError) as error:
+        store.append(state['upload_id'], len(DATA) - 1000, BytesIO(DATA[-1000:]))
+
+    assert error.value.status == 409
+    assert error.value.offset == len(DATA)
+
+def test_chunk_beyond_declared_size_is_refused(store):
+    upload_id = store.create('doc.psd', 1000)['upload_id']
+
+    with pytest.raises(UploadError) as error:
+        store.append(upload_id, 0, BytesIO(DATA[:1001]))
+
+    assert error.value.status == 413
+    assert store.status(upload_id)['offset'] == 0
+
+def test_chunk_is_refused_while_another_is_being_written(store):
+    upload_id = store.create('doc.psd', len(DATA))['upload_id']
+
+    with open(store._state_path(upload_id), 'r+') as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        with pytest.raises(UploadError) as error:
+            store.append(upload_id, 0, BytesIO(DATA[:1000]))
+
+    assert error.value.status == 409
+    assert error.value.offset == 0
+
+def test_identical_uploads_share_one_file(store, tmp_path):
+    first = upload_all(store, DATA)
+    second = upload_all(store, DATA, chunk_size=3000)
+
+    assert second['filepath'] == first['filepath']
+    assert not [name for name in os.listdir(store.root) if name.endswith('.part')]
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.psd')] == [os.path.basename(first['filepath'])]
+
+def test_recorded_job_is_kept_in_state(store):
+    state = upload_all(store, DATA)
+
+    store.record_job(state['upload_id'], 'job-1')
+
+    assert store.status(state['upload_id'])['job_id'] == 'job-1'
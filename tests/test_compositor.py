@@ -0,0 +1,126 @@
+import pytest
+from PIL import Image
+
+from utils.compositor import Compositor, blend_mode_name, make_item
+
+def solid(color, size=(4, 4)):
+    return Image.new('RGBA', size, color)
+
+def composite(*items, mode='RGB'):
+    canvas = Compositor((4, 4))
+    canvas.paint_all(items)
+    return canvas.to_array(mode)
+
+def backdrop(value):
+    return make_item('backdrop', (0, 0), solid((value, value, value, 255)))
+
+# Expected values worked out by hand from the W3C formulas, backdrop 200 under source 100
+@pytest.mark.parametrize('mode, expected', [
+    ('normal', 100),
+    ('multiply', 78),
+    ('screen', 222),
+    ('overlay', 188),
+    ('darken', 100),
+    ('lighten', 200),
+    ('color_dodge', 255),
+    ('color_burn', 115),
+    ('hard_light', 157),
+    ('soft_light', 191),
+    ('difference', 100),
+    ('exclusion', 143),
+    ('linear_dodge', 255),
+    ('linear_burn', 45),
+    ('subtract', 100),
+])
+def test_blend_mode_on_opaque_backdrop(mode, expected):
+    source = make_item('source', (0, 0), solid((100, 100, 100, 255)), blend_mode=mode)
+
+    pixels = composite(backdrop(200), source)
+
+    assert (pixels == expected).all()
+
+# Backdrop 50 under source 200 takes the other branch of the piecewise modes
+@pytest.mark.parametrize('mode, expected', [
+    ('overlay', 78),
+    ('color_dodge', 232),
+    ('color_burn', 0),
+    ('hard_light', 167),
+    ('soft_light', 86),
+])
+def test_piecewise_blend_mode_other_branch(mode, expected):
+    source = make_item('source', (0, 0), solid((200, 200, 200, 255)), blend_mode=mode)
+
+    pixels = composite(backdrop(50), source)
+
+    assert (pixels == expected).all()
+
+def test_blend_modes_work_per_channel():
+    under = make_item('under', (0, 0), solid((255, 128, 0, 255)))
+    source = make_item('source', (0, 0), solid((128, 255, 64, 255)), blend_mode='multiply')
+
+    pixels = composite(under, source)
+
+    assert tuple(pixels[0, 0]) == (128, 128, 0)
+
+def test_blend_mode_against_transparency_keeps_source_color():
+    source = make_item('source', (0, 0), solid((100, 150, 200, 255)), blend_mode='multiply')
+
+    pixels = composite(source, mode='RGBA')
+
+    assert tuple(pixels[0, 0]) == (100, 150, 200, 255)
+
+def test_opacity_mixes_with_backdrop():
+    white = backdrop(255)
+    red = make_item('red', (0, 0), solid((255, 0, 0, 255)), opacity=0.25)
+
+    pixels = composite(white, red)
+
+    # 0.25 * 0 + 0.75 * 255 = 191.25
+    assert tuple(pixels[0, 0]) == (255, 191, 191)
+
+def test_opacity_applies_to_blended_color():
+    source = make_item('source', (0, 0), solid((100, 100, 100, 255)), opacity=0.5, blend_mode='multiply')
+
+    pixels = composite(backdrop(200), source)
+
+    # Halfway between the backdrop and the multiplied 78.43
+    assert (pixels == 139).all()
+
+def test_zero_opacity_leaves_canvas_untouched():
+    source = make_item('source', (0, 0), solid((0, 0, 0, 255)), opacity=0.0)
+
+    pixels = composite(backdrop(200), source)
+
+    assert (pixels == 200).all()
+
+def test_mask_is_folded_into_alpha():
+    mask = Image.new('L', (4, 4), 0)
+    mask.paste(255, (0, 0, 2, 4))
+    mask.paste(128, (2, 0, 3, 4))
+    item = make_item('masked', (0, 0), solid((0, 0, 0, 255)), mask=mask)
+
+    assert not item.opaque
+    assert item.pixels[3, 0].tolist() == [255, 255, 128, 0]
+
+    pixels = composite(backdrop(255), item)
+
+    assert pixels[0, :, 0].tolist() == [0, 0, 127, 255]
+
+def test_mask_multiplies_existing_alpha():
+    item = make_item('masked', (0, 0), solid((0, 0, 0, 128)), mask=Image.new('L', (4, 4), 128))
+
+    assert (item.pixels[3] == 128 * 128 // 255).all()
+
+def test_layer_outside_canvas_is_clipped():
+    item = make_item('offset', (2, -2), solid((0, 0, 0, 255)))
+
+    pixels = composite(backdrop(255), item)
+
+    assert (pixels[:2, 2:] == 0).all()
+    assert (pixels[2:] == 255).all()
+    assert (pixels[:, :2] == 255).all()
+
+def test_unknown_blend_mode_falls_back_to_normal():
+    assert blend_mode_name('pin_light') == 'normal'
+    assert blend_mode_name(None) == 'normal'
+    assert blend_mode_name('Multiply') == 'multiply'
@@ -0,0 +1,114 @@
+import os
+import time
+
+import pytest
+
+from utils.export_cache import ExportCache
+
+@pytest.fixture
+def cache(tmp_path):
+    return ExportCache(str(tmp_path / 'exports'), max_bytes=250)
+
+def write(cache, name, size=100, age=0):
+    """Write an export of ``size`` bytes last used ``age`` seconds ago."""
+    path = os.path.join(cache.root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    used = time.time() - age
+    os.utime(path, (used, used))
+    return path
+
+def age_directory(path, age):
+    used = time.time() - age
+    os.utime(path, (used, used))
+
+def remaining(cache):
+    return sorted(os.listdir(cache.root))
+
+def test_nothing_is_evicted_under_the_limit(cache):
+    write(cache, 'a.png', age=20)
+    write(cache, 'b.png', age=10)
+
+    cache.evict()
+
+    assert remaining(cache) == ['a.png', 'b.png']
+
+def test_least_recently_used_goes_first(cache):
+    write(cache, 'old.png', age=30)
+    write(cache, 'middle.png', age=20)
+    write(cache, 'new.png', age=10)
+
+    cache.evict()
+
+    assert remaining(cache) == ['middle.png', 'new.png']
+    assert cache.size() == 200
+
+def test_lookup_marks_export_as_used(cache):
+    old = write(cache, 'old.png', age=30)
+    write(cache, 'middle.png', age=20)
+    write(cache, 'new.png', age=10)
+
+    assert cache.lookup(old)
+    cache.evict()
+
+    assert remaining(cache) == ['new.png', 'old.png']
+
+def test_lookup_of_missing_export_is_a_miss(cache):
+    assert not cache.lookup(os.path.join(cache.root, 'missing.png'))
+
+def test_kept_exports_are_never_removed(cache):
+    old = write(cache, 'old.png', age=30)
+    write(cache, 'middle.png', age=20)
+    write(cache, 'new.png', age=10)
+
+    cache.evict(keep=[old])
+
+    assert remaining(cache) == ['new.png', 'old.png']
+
+def test_kept_exports_stay_even_if_they_alone_exceed_the_limit(cache):
+    big = write(cache, 'big.png', size=300, age=30)
+    write(cache, 'other.png', age=10)
+
+    cache.evict(keep=[big])
+
+    assert remaining(cache) == ['big.png']
+
+def test_exports_being_written_are_left_alone(cache):
+    write(cache, '.partial.png', size=300, age=30)
+    write(cache, 'a.png', age=20)
+    write(cache, 'b.png', age=10)
+
+    cache.evict()
+
+    assert remaining(cache) == ['.partial.png', 'a.png', 'b.png']
+
+def test_finished_variant_directory_is_evicted_whole(cache):
+    write(cache, 'variants/one.png', size=100)
+    write(cache, 'variants/two.png', size=100)
+    write(cache, 'variants/manifest.json', size=10)
+    age_directory(os.path.join(cache.root, 'variants'), 30)
+    write(cache, 'new.png', age=10)
+
+    assert cache.size() == 310
+    cache.evict()
+
+    assert remaining(cache) == ['new.png']
+
+def test_variant_directory_being_written_is_left_alone(cache):
+    write(cache, 'variants/one.png', size=300)
+    age_directory(os.path.join(cache.root, 'variants'), 30)
+    write(cache, 'new.png', age=10)
+
+    cache.evict()
+
+    assert remaining(cache) == ['new.png', 'variants']
+
+def test_abandoned_variant_directory_is_evicted(cache):
+    write(cache, 'variants/one.png', size=300)
+    age_directory(os.path.join(cache.root, 'variants'), ExportCache.ABANDONED_SECONDS + 60)
+    write(cache, 'new.png', age=10)
+
+    cache.evict()
+
+    assert remaining(cache) == ['new.png']
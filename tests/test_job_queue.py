@@ -0,0 +1,117 @@
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+
+import pytest
+
+from utils.job_queue import JobQueue, job_handler
+
+@job_handler('test_echo')
+def echo_job(payload, progress):
+    progress(0.5)
+    return {'echo': payload}
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.sqlite3'), lease_seconds=60, max_attempts=2)
+
+def expire_lease(queue, job_id):
+    """Make a running job look as if its worker stopped heartbeating long ago."""
+    past = (datetime.utcnow() - timedelta(seconds=queue.lease_seconds + 1)).isoformat()
+    with closing(sqlite3.connect(queue.db_path, isolation_level=None)) as conn:
+        conn.execute('UPDATE jobs SET started_at = ?, heartbeat_at = ? WHERE id = ?', (past, past, job_id))
+
+def test_claim_takes_oldest_job_and_leases_it(queue):
+    first = queue.submit('test_echo', {'n': 1})
+    queue.submit('test_echo', {'n': 2})
+
+    job = queue.claim()
+
+    assert job['id'] == first
+    assert job['status'] == 'running'
+    assert job['attempts'] == 1
+    assert job['heartbeat_at'] is not None
+
+def test_live_lease_is_not_reclaimed(queue):
+    job_id = queue.submit('test_echo', {})
+    queue.claim()
+
+    assert queue.claim() is None
+    assert queue.get(job_id)['status'] == 'running'
+
+def test_expired_lease_is_queued_again(queue):
+    job_id = queue.submit('test_echo', {})
+    queue.claim()
+    expire_lease(queue, job_id)
+
+    job = queue.claim()
+
+    assert job['id'] == job_id
+    assert job['status'] == 'running'
+    assert job['attempts'] == 2
+
+def test_heartbeat_renews_lease(queue):
+    job_id = queue.submit('test_echo', {})
+    queue.claim()
+    expire_lease(queue, job_id)
+
+    queue.heartbeat(job_id)
+
+    assert queue.claim() is None
+
+def test_job_fails_once_attempts_are_used_up(queue):
+    job_id = queue.submit('test_echo', {})
+    queue.claim()
+    expire_lease(queue, job_id)
+    queue.claim()
+    expire_lease(queue, job_id)
+
+    assert queue.claim() is None
+    job = queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert job['error'] == 'Job worker stopped responding'
+
+def test_run_stores_result(queue):
+    job_id = queue.submit('test_echo', {'n': 1})
+
+    queue.run(queue.claim())
+
+    job = queue.get(job_id)
+    assert job['status'] == 'finished'
+    assert job['progress'] == 1.0
+    assert job['result'] == {'echo': {'n': 1}}
+
+def test_outcome_of_reclaimed_attempt_is_discarded(queue):
+    job_id = queue.submit('test_echo', {'n': 1})
+    stale = queue.claim()
+    expire_lease(queue, job_id)
+    current = queue.claim()
+
+    # The first worker comes back after its lease ran out
+    queue.run(stale)
+    assert queue.get(job_id)['status'] == 'running'
+
+    queue.run(current)
+    assert queue.get(job_id)['status'] == 'finished'
+
+def test_shared_data_is_stored_once_and_removed(queue):
+    shared_id = queue.share({'layers': {'1': {'blob_id': 'a' * 64}}})
+
+    assert queue.shared(shared_id) == {'layers': {'1': {'blob_id': 'a' * 64}}}
+    assert queue.all_shared() == [{'layers': {'1': {'blob_id': 'a' * 64}}}]
+
+    queue.unshare(shared_id)
+
+    assert queue.shared(shared_id) is None
+    assert queue.all_shared() == []
+
+def test_abandoned_shared_data_expires(queue):
+    old = queue.share({'n': 1})
+    past = (datetime.utcnow() - timedelta(seconds=queue.SHARED_MAX_AGE + 1)).isoformat()
+    with closing(sqlite3.connect(queue.db_path, isolation_level=None)) as conn:
+        conn.execute('UPDATE shared SET created_at = ? WHERE id = ?', (past, old))
+
+    new = queue.share({'n': 2})
+
+    assert queue.shared(old) is None
+    assert queue.shared(new) == {'n': 2}
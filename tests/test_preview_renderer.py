@@ -0,0 +1,76 @@
+import pytest
+from PIL import Image
+
+from utils.blob_store import BlobStore
+from utils.layer_manager import LayerManager
+from utils.layer_session import LayerSession
+from utils.preview_renderer import PreviewRenderer
+
+RED = (255, 0, 0)
+BLUE = (0, 0, 255)
+
+@pytest.fixture
+def blobs(app):
+    return BlobStore.for_app(app)
+
+def layers(blobs, color):
+    return [{
+        'id': '1',
+        'name': 'fill',
+        'type': 'image',
+        'visible': True,
+        'opacity': 1.0,
+        'bounds': {'x': 0, 'y': 0, 'width': 64, 'height': 64},
+        'processed_content': blobs.put_image(Image.new('RGBA', (64, 64), color + (255,)))
+    }]
+
+def tile_color(renderer, session):
+    _, tile = renderer.render_tile(LayerManager(session=session), 1.0, 0, 0)
+    return tile.convert('RGB').getpixel((5, 5))
+
+def test_reloaded_session_does_not_serve_previous_documents_tiles(blobs):
+    renderer = PreviewRenderer(tile_size=64)
+    session = LayerSession('1')
+    session.load('first.psd', layers(blobs, RED))
+    assert tile_color(renderer, session) == RED
+
+    session.load('second.psd', layers(blobs, BLUE))
+
+    assert tile_color(renderer, session) == BLUE
+
+def test_new_session_at_same_revision_does_not_serve_previous_tiles(blobs):
+    renderer = PreviewRenderer(tile_size=64)
+    first = LayerSession('1')
+    first.load('first.psd', layers(blobs, RED))
+    assert tile_color(renderer, first) == RED
+
+    # A re-upload drops the session; the next one starts over at the same revision
+    second = LayerSession('1')
+    second.load('second.psd', layers(blobs, BLUE))
+    assert second.revision == first.revision
+
+    assert tile_color(renderer, second) == BLUE
+
+def test_unchanged_session_reuses_tile(blobs):
+    renderer = PreviewRenderer(tile_size=64)
+    session = LayerSession('1')
+    session.load('first.psd', layers(blobs, RED))
+    manager = LayerManager(session=session)
+
+    _, first = renderer.render_tile(manager, 1.0, 0, 0)
+    _, second = renderer.render_tile(manager, 1.0, 0, 0)
+
+    assert second is first
+
+def test_dirty_tiles_of_another_epoch_ask_for_everything(blobs):
+    renderer = PreviewRenderer(tile_size=64)
+    session = LayerSession('1')
+    session.load('first.psd', layers(blobs, RED))
+    manager = LayerManager(session=session)
+    epoch, revision = session.epoch, session.revision
+    assert renderer.dirty_tiles(manager, 1.0, revision, epoch) == []
+
+    session.load('second.psd', layers(blobs, BLUE))
+
+    assert session.epoch != epoch
+    assert renderer.dirty_tiles(manager, 1.0, revision, epoch) is None
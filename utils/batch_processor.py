@@ -0,0 +1,71 @@
+import time
+from utils.job_queue import JobQueue
+from utils.offload import offload
+
+class BatchProcessor:
+    """Run many documents or template variants on the job workers.
+
+    Every item becomes one background job, so a batch is spread over the
+    long-lived worker processes instead of forking a pool per request.
+    Results are yielded as soon as each item finishes, tagged with the
+    item's index in the request, so callers can stream them to the client.
+    Closing the stream early cancels the items that have not started yet.
+    """
+
+    def __init__(self, app, poll_interval=None):
+        self.app = app
+        self.queue = JobQueue.for_app(app)
+        self.poll_interval = poll_interval or app.config.get('JOB_POLL_INTERVAL', 0.5)
+
+    def _run(self, kind, payloads):
+        if not payloads:
+            return
+        pending = {self.queue.submit(kind, payload): index for index, payload in enumerate(payloads)}
+        try:
+            while pending:
+                # SQLite calls block, so keep them off the event loop in async mode
+                for job in offload(self.queue.get_many, list(pending)):
+                    if job['status'] not in ('finished', 'failed', 'cancelled'):
+                        continue
+                    index = pending.pop(job['id'])
+                    result = dict(job['result']) if isinstance(job['result'], dict) else {}
+                    if job['status'] == 'finished':
+                        result.setdefault('success', True)
+                    else:
+                        result.update(success=False, error=job['error'] or result.get('error') or job['status'])
+                    if 'filepath' in payloads[index]:
+                        result.setdefault('filepath', payloads[index]['filepath'])
+                    result['index'] = index
+                    yield result
+                if pending:
+                    time.sleep(self.poll_interval)
+        finally:
+            if pending:
+                self.queue.cancel(list(pending))
+
+    def process_files(self, filepaths):
+        """Parse many documents concurrently, yielding each result as it finishes."""
+        return self._run('process_document', [{'filepath': filepath} for filepath in filepaths])
+
+    def render_variants(self, session_data, substitutions, sizes, formats=('png',)):
+        """Render one template once per substitution, yielding export results as they finish.
+
+        The template is stored in the queue once and shared by the items'
+        jobs, whose payloads only hold its id and their substitution.
+
+        Args:
+            session_data (dict): Serialized ``LayerSession`` of the template
+            substitutions (list): Dicts of the form ``{'layers': {layer_id: content}}``
+            sizes (list): Export sizes passed to ``LayerManager.export_documents``
+            formats (list): Export formats
+        """
+        if not substitutions:
+            return
+        shared_id = self.queue.share(session_data)
+        try:
+            yield from self._run('render_variant', [
+                {'shared_session': shared_id, 'substitution': substitution, 'sizes': list(sizes), 'formats': list(formats)}
+                for substitution in substitutions
+            ])
+        finally:
+            self.queue.unshare(shared_id)
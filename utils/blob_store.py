@@ -0,0 +1,209 @@
+import os
+import re
+import json
+import time
+import base64
+import hashlib
+import logging
+import tempfile
+from io import BytesIO
+from utils.metrics import metrics
+from utils.encoders import INTERMEDIATE_COMPRESS_LEVEL
+from utils.lazy_import import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger(__name__)
+
+BLOB_ID = re.compile(r'^[0-9a-f]{64}$')
+
+class BlobStore:
+    """Content-addressed on-disk store for layer pixel data.
+
+    Images are kept as losslessly compressed PNG files named by the SHA-256
+    of their bytes. Layer dicts only carry a small reference of the form
+    ``{'blob_id', 'format', 'size'}``; base64 is produced by ``inline()`` at
+    the HTTP boundary, when a client explicitly asks for inline data.
+
+    Blobs are shared between documents, so they are never deleted when one
+    layer stops using them. ``collect`` sweeps the ones nothing refers to
+    any more, see ``referenced_blobs`` and ``flask blobs-gc``.
+    """
+
+    # Fast zlib level: layer blobs are intermediates, not deliverables
+    COMPRESS_LEVEL = INTERMEDIATE_COMPRESS_LEVEL
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def for_app(cls, app):
+        """Return the blob store bound to a Flask app, creating it on first use."""
+        store = app.extensions.get('blob_store')
+        if store is None:
+            store = cls(app.config.get('BLOB_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'blobs')))
+            app.extensions['blob_store'] = store
+        return store
+
+    def path(self, blob_id):
+        # Shard by prefix so no single directory grows unbounded
+        return os.path.join(self.root, blob_id[:2], f'{blob_id}.png')
+
+    def exists(self, blob_id):
+        return os.path.exists(self.path(blob_id))
+
+    def put_bytes(self, data):
+        """Store already-encoded PNG bytes and return their blob id."""
+        blob_id = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_id)
+        try:
+            # Reused blobs count as new, so a sweep running meanwhile keeps them
+            os.utime(path, None)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return blob_id
+
+    def put_image(self, image):
+        """Store a PIL image and return a layer content reference."""
+        buffered = BytesIO()
+        with metrics.timer('png_encode'):
+            image.save(buffered, format='PNG', compress_level=self.COMPRESS_LEVEL)
+        return {
+            'blob_id': self.put_bytes(buffered.getvalue()),
+            'format': image.mode,
+            'size': image.size
+        }
+
+    def get_bytes(self, blob_id):
+        with open(self.path(blob_id), 'rb') as f:
+            return f.read()
+
+    def get_image(self, blob_id):
+        """Load a stored blob as a fully decoded PIL image."""
+        with Image.open(self.path(blob_id)) as img:
+            img.load()
+            return img.copy()
+
+    def load_content(self, content):
+        """Decode a layer content dict into a PIL image.
+
+        Accepts blob references as well as the legacy inline
+        ``{'data': <base64 PNG>}`` format still found in older projects.
+        """
+        if not isinstance(content, dict):
+            return None
+        if 'blob_id' in content:
+            return self.get_image(content['blob_id'])
+        if 'data' in content:
+            img = Image.open(BytesIO(base64.b64decode(content['data'])))
+            img.load()
+            return img
+        return None
+
+    def collect(self, referenced, grace_seconds=24 * 3600):
+        """Delete blobs not in ``referenced`` that were last written over ``grace_seconds`` ago.
+
+        The grace period covers blobs that are only referenced from memory so
+        far, e.g. by an edit that has not been saved to its Layer row yet.
+
+        Returns:
+            tuple: Number of blobs removed and bytes freed
+        """
+        cutoff = time.time() - grace_seconds
+        removed, freed = 0, 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                blob_id, ext = os.path.splitext(filename)
+                if ext != '.png' or not BLOB_ID.match(blob_id) or blob_id in referenced:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime > cutoff:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+        logger.info(f"Removed {removed} unreferenced blobs, {freed} bytes")
+        return removed, freed
+
+    def inline(self, content):
+        """Return a copy of a content reference with base64 PNG ``data`` added."""
+        if not isinstance(content, dict) or 'blob_id' not in content:
+            return content
+        inlined = dict(content)
+        data = self.get_bytes(content['blob_id'])
+        with metrics.timer('base64_encode'):
+            inlined['data'] = base64.b64encode(data).decode('utf-8')
+        return inlined
+
+def _collect_ids(value, found):
+    """Add every blob id in a decoded JSON value to ``found``."""
+    if isinstance(value, dict):
+        for item in value.values():
+            _collect_ids(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_ids(item, found)
+    elif isinstance(value, str) and BLOB_ID.match(value):
+        found.add(value)
+
+def _collect_json(text, found):
+    try:
+        _collect_ids(json.loads(text) if text else None, found)
+    except ValueError:
+        pass
+
+def referenced_blobs(app):
+    """Return the ids of all blobs something may still read.
+
+    That is every id in layer rows (pixels and thumbnails), legacy project
+    file layers, saved layer sessions, the parse cache's layers and
+    thumbnails, and the payloads of jobs that have not finished together
+    with the data they share.
+    """
+    from extensions import db
+    from models import Layer, ProjectFile
+    from utils.job_queue import JobQueue
+    found = set()
+    with app.app_context():
+        for content, properties in db.session.query(Layer.content, Layer.properties).yield_per(1000):
+            _collect_json(content, found)
+            _collect_json(properties, found)
+        for (layers,) in db.session.query(ProjectFile.layers).yield_per(1000):
+            _collect_json(layers, found)
+    folders = [app.config['LAYER_SESSION_FOLDER'], app.config['PARSE_CACHE_FOLDER']]
+    for folder in folders:
+        for dirpath, _, filenames in os.walk(folder):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    try:
+                        with open(os.path.join(dirpath, filename), 'r') as f:
+                            _collect_json(f.read(), found)
+                    except OSError:
+                        pass
+    queue = JobQueue.for_app(app)
+    for status in ('queued', 'running'):
+        for job in queue.with_status(status):
+            _collect_ids(job['payload'], found)
+    for data in queue.all_shared():
+        _collect_ids(data, found)
+    return found
+
+def register_blob_commands(app):
+    """Add the ``flask blobs-gc`` command that deletes unreferenced blobs."""
+    import click
+
+    @app.cli.command('blobs-gc')
+    @click.option('--grace', default=24 * 3600, help='Keep unreferenced blobs written less than this many seconds ago.')
+    def blobs_gc(grace):
+        """Delete layer blobs and thumbnails that nothing refers to any more."""
+        removed, freed = BlobStore.for_app(app).collect(referenced_blobs(app), grace)
+        click.echo(f'Removed {removed} blobs ({freed} bytes)')
@@ -0,0 +1,173 @@
+import os
+import json
+import uuid
+import fcntl
+import hashlib
+import threading
+from werkzeug.utils import secure_filename
+
+# Size of the blocks read from the request stream and the part file
+BLOCK_SIZE = 1024 * 1024
+
+class UploadError(Exception):
+    """Raised when a chunk cannot be accepted."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+class ChunkedUploadStore:
+    """Resumable uploads written straight to disk in sequential chunks.
+
+    Each upload has a ``.part`` file and a ``.json`` state file under
+    ``root``. Chunks must arrive in order at the current offset, so the
+    SHA-256 of the file is computed while it streams in, using constant
+    memory. Once the last byte lands the file is moved to ``target_folder``
+    under its content hash, which deduplicates identical uploads.
+    """
+
+    # In-process running hashes: upload_id -> (offset, sha256 object)
+    _hashers = {}
+    _hashers_lock = threading.Lock()
+
+    def __init__(self, root, target_folder, max_size):
+        self.root = root
+        self.target_folder = target_folder
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_app(cls, app):
+        return cls(
+            app.config.get('CHUNKED_UPLOAD_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'partial')),
+            app.config['UPLOAD_FOLDER'],
+            app.config.get('MAX_UPLOAD_SIZE', 4 * 1024 * 1024 * 1024)
+        )
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.root, f'{upload_id}.part')
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.root, f'{upload_id}.json')
+
+    def _read_state(self, upload_id):
+        try:
+            with open(self._state_path(upload_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise UploadError('Upload not found', 404)
+
+    def _write_state(self, state):
+        tmp_path = f"{self._state_path(state['upload_id'])}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._state_path(state['upload_id']))
+
+    def create(self, filename, size, **metadata):
+        """Start a new upload and return its state."""
+        if size <= 0:
+            raise UploadError('Upload size must be positive')
+        if size > self.max_size:
+            raise UploadError('Upload exceeds the maximum allowed size', 413)
+        upload_id = uuid.uuid4().hex
+        state = {
+            'upload_id': upload_id,
+            'filename': secure_filename(filename),
+            'size': size,
+            'offset': 0,
+            'complete': False,
+            'metadata': metadata
+        }
+        open(self._part_path(upload_id), 'wb').close()
+        self._write_state(state)
+        return state
+
+    def status(self, upload_id):
+        return self._read_state(upload_id)
+
+    def record_job(self, upload_id, job_id):
+        """Remember the job that parses a completed upload, for clients that ask again."""
+        with open(self._state_path(upload_id), 'r+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = self._read_state(upload_id)
+            state['job_id'] = job_id
+            self._write_state(state)
+        return state
+
+    def _hasher_at(self, upload_id, offset):
+        """Return a SHA-256 object covering the first ``offset`` bytes of the part file."""
+        with self._hashers_lock:
+            entry = self._hashers.pop(upload_id, None)
+        if entry is not None and entry[0] == offset:
+            return entry[1]
+        # Another process took the earlier chunks; rebuild the hash from disk
+        sha = hashlib.sha256()
+        with open(self._part_path(upload_id), 'rb') as f:
+            remaining = offset
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                sha.update(block)
+                remaining -= len(block)
+        return sha
+
+    def append(self, upload_id, offset, stream):
+        """Append a chunk read from ``stream`` at ``offset`` and return the new state.
+
+        The state file is locked for the duration. A request for an upload
+        whose lock is held, by a retry racing a chunk still streaming in, is
+        refused with a 409 rather than waiting: under gevent the holder may
+        be a greenlet of this very thread.
+        """
+        try:
+            lock_file = open(self._state_path(upload_id), 'r+')
+        except OSError:
+            raise UploadError('Upload not found', 404)
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError('Another chunk of this upload is still being written', 409,
+                                  self._read_state(upload_id)['offset'])
+            state = self._read_state(upload_id)
+            if state['complete']:
+                raise UploadError('Upload already complete', 409, state['offset'])
+            if offset != state['offset']:
+                raise UploadError('Chunk offset does not match upload offset', 409, state['offset'])
+
+            sha = self._hasher_at(upload_id, offset)
+            written = 0
+            with open(self._part_path(upload_id), 'r+b') as part:
+                part.seek(offset)
+                part.truncate()
+                while True:
+                    block = stream.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    written += len(block)
+                    if offset + written > state['size']:
+                        part.truncate(offset)
+                        raise UploadError('Chunk exceeds declared upload size', 413, offset)
+                    part.write(block)
+                    sha.update(block)
+
+            state['offset'] = offset + written
+            if state['offset'] == state['size']:
+                state.update(self._finalize(upload_id, state, sha.hexdigest()))
+            else:
+                with self._hashers_lock:
+                    self._hashers[upload_id] = (state['offset'], sha)
+            self._write_state(state)
+            return state
+
+    def _finalize(self, upload_id, state, digest):
+        ext = os.path.splitext(state['filename'])[1].lower()
+        filepath = os.path.join(self.target_folder, f'{digest}{ext}')
+        if os.path.exists(filepath):
+            # Identical content was uploaded before
+            os.remove(self._part_path(upload_id))
+        else:
+            os.replace(self._part_path(upload_id), filepath)
+        return {'complete': True, 'sha256': digest, 'filepath': filepath}
@@ -0,0 +1,200 @@
+from collections import namedtuple
+from utils.lazy_import import lazy_import
+
+Image = lazy_import('PIL.Image')
+np = lazy_import('numpy')
+
+# One layer ready to composite: ``pixels`` is a planar ``(4, height, width)``
+# RGBA uint8 array with the layer mask already folded into its alpha plane;
+# ``opaque`` is set when every pixel has full alpha
+PaintItem = namedtuple('PaintItem', 'layer_id position pixels opacity blend_mode opaque')
+
+def _soft_light(cb, cs):
+    d = np.where(cb <= 0.25, ((16 * cb - 12) * cb + 4) * cb, np.sqrt(cb))
+    return np.where(cs <= 0.5, cb - (1 - 2 * cs) * cb * (1 - cb), cb + (2 * cs - 1) * (d - cb))
+
+def _hard_light(cb, cs):
+    return np.where(cs <= 0.5, cb * 2 * cs, 1 - (1 - cb) * (1 - (2 * cs - 1)))
+
+def _color_dodge(cb, cs):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(cb == 0, 0.0, np.where(cs >= 1, 1.0, np.minimum(1.0, cb / (1 - cs))))
+
+def _color_burn(cb, cs):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(cb >= 1, 1.0, np.where(cs <= 0, 0.0, 1 - np.minimum(1.0, (1 - cb) / cs)))
+
+# Separable blend functions B(backdrop, source) on straight colors in [0, 1]
+BLEND_MODES = {
+    'normal': None,
+    'multiply': lambda cb, cs: cb * cs,
+    'screen': lambda cb, cs: cb + cs - cb * cs,
+    'overlay': lambda cb, cs: _hard_light(cs, cb),
+    'darken': lambda cb, cs: np.minimum(cb, cs),
+    'lighten': lambda cb, cs: np.maximum(cb, cs),
+    'color_dodge': _color_dodge,
+    'color_burn': _color_burn,
+    'hard_light': _hard_light,
+    'soft_light': _soft_light,
+    'difference': lambda cb, cs: np.abs(cb - cs),
+    'exclusion': lambda cb, cs: cb + cs - 2 * cb * cs,
+    'linear_dodge': lambda cb, cs: np.minimum(1.0, cb + cs),
+    'linear_burn': lambda cb, cs: np.maximum(0.0, cb + cs - 1),
+    'subtract': lambda cb, cs: np.maximum(0.0, cb - cs),
+}
+
+def blend_mode_name(blend_mode):
+    """Normalize a blend mode name, falling back to ``normal`` for unsupported ones."""
+    name = str(blend_mode or 'normal').lower()
+    return name if name in BLEND_MODES else 'normal'
+
+def make_item(layer_id, position, image, mask=None, opacity=1.0, blend_mode='normal', allocate=None):
+    """Build a ``PaintItem`` from a PIL image and an optional ``L`` mask of the same size.
+
+    ``allocate(shape)`` can supply the pixel array, e.g. a memory-mapped one;
+    the image is copied into it one channel at a time.
+    """
+    rgba = image if image.mode == 'RGBA' else image.convert('RGBA')
+    width, height = rgba.size
+    pixels = allocate((4, height, width)) if allocate else np.empty((4, height, width), np.uint8)
+    for index in range(4):
+        pixels[index] = np.asarray(rgba.getchannel(index))
+    del rgba
+    if mask is not None:
+        mask = np.asarray(mask.convert('L'))
+        for top in range(0, height, 1024):
+            rows = slice(top, top + 1024)
+            pixels[3, rows] = (pixels[3, rows].astype(np.uint16) * mask[rows] // 255).astype(np.uint8)
+    opaque = bool(pixels.size) and int(pixels[3].min()) == 255
+    return PaintItem(layer_id, tuple(position), pixels, float(opacity), blend_mode_name(blend_mode), opaque)
+
+def scale_item(item, zoom):
+    """Return a copy of ``item`` resized by ``zoom``, positioned on the zoomed canvas.
+
+    Edges are rounded on the zoomed canvas, so neighbouring layers still meet
+    without gaps.
+    """
+    x, y = item.position
+    height, width = item.pixels.shape[1:]
+    left, top = round(x * zoom), round(y * zoom)
+    size = (max(1, round((x + width) * zoom) - left), max(1, round((y + height) * zoom) - top))
+    if not item.pixels.size:
+        return item._replace(position=(left, top))
+    # PIL resamples RGBA with premultiplied alpha, so transparent pixels don't bleed in
+    image = Image.merge('RGBA', [Image.fromarray(np.ascontiguousarray(plane)) for plane in item.pixels])
+    scaled = np.asarray(image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0))
+    pixels = np.ascontiguousarray(np.moveaxis(scaled, -1, 0))
+    return item._replace(position=(left, top), pixels=pixels, opaque=item.opaque and int(pixels[3].min()) == 255)
+
+def item_rect(item):
+    """Canvas rectangle ``(left, top, right, bottom)`` covered by an item."""
+    x, y = item.position
+    return x, y, x + item.pixels.shape[2], y + item.pixels.shape[1]
+
+class Compositor:
+    """Composite layers onto a transparent, premultiplied float32 RGBA canvas.
+
+    Each layer is blended as a whole with vectorized NumPy operations,
+    restricted to the part of the canvas it overlaps. Canvas and layers are
+    stored as planes rather than interleaved pixels, which keeps every
+    operation on contiguous memory. Opacity and blend
+    modes follow the W3C compositing model, which is what Photoshop uses
+    for the separable modes. Like Photoshop, layers are blended against
+    transparency and the result is only flattened onto a background color
+    by ``to_image``.
+    """
+
+    def __init__(self, size):
+        width, height = size
+        self.size = (width, height)
+        self.pixels = np.zeros((4, height, width), np.float32)
+
+    def copy(self):
+        clone = Compositor.__new__(Compositor)
+        clone.size = self.size
+        clone.pixels = self.pixels.copy()
+        return clone
+
+    def paint(self, item, offset=(0, 0)):
+        """Composite one item, its position shifted by ``offset``."""
+        x, y = item.position[0] + offset[0], item.position[1] + offset[1]
+        height, width = item.pixels.shape[1:]
+        left, top = max(0, -x), max(0, -y)
+        right, bottom = min(width, self.size[0] - x), min(height, self.size[1] - y)
+        if right <= left or bottom <= top or item.opacity <= 0:
+            return
+        source = item.pixels[:, top:bottom, left:right]
+        target = self.pixels[:, y + top:y + bottom, x + left:x + right]
+        blend = BLEND_MODES[item.blend_mode]
+
+        if blend is None and item.opaque and item.opacity >= 1:
+            # Opaque normal layers simply replace what is below them
+            np.multiply(source[:3], np.float32(1 / 255), out=target[:3])
+            target[3] = 1.0
+            return
+
+        alpha = np.multiply(source[3], np.float32(item.opacity / 255), dtype=np.float32)
+        color = np.multiply(source[:3], np.float32(1 / 255), dtype=np.float32)
+        if blend is None:
+            # Normal mode in premultiplied form: dst = src * a + dst * (1 - a)
+            color *= alpha
+            target *= 1 - alpha
+            target[:3] += color
+            target[3] += alpha
+            return
+
+        backdrop_alpha = target[3]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            backdrop = np.where(backdrop_alpha > 0, target[:3] / backdrop_alpha, 0.0)
+        blended = np.clip(blend(backdrop, color), 0.0, 1.0)
+        target[:3] = (
+            color * (alpha * (1 - backdrop_alpha))
+            + target[:3] * (1 - alpha)
+            + blended * (alpha * backdrop_alpha)
+        )
+        target[3] = alpha + backdrop_alpha * (1 - alpha)
+
+    def paint_all(self, items, offset=(0, 0)):
+        for item in items:
+            self.paint(item, offset)
+
+    def over(self, other):
+        """Composite another (premultiplied) canvas of the same size on top, normal mode."""
+        self.pixels *= 1 - other.pixels[3]
+        self.pixels += other.pixels
+
+    def to_array(self, mode='RGB', background=(255, 255, 255)):
+        """Return the canvas as interleaved uint8, ``RGB`` flattened onto ``background``."""
+        alpha = self.pixels[3]
+        if mode == 'RGB':
+            planes = self.pixels[:3] + (np.asarray(background, np.float32) / 255)[:, None, None] * (1 - alpha)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                planes = np.where(alpha > 0, self.pixels[:3] / alpha, 0.0)
+            planes = np.concatenate([planes, alpha[None]])
+        planes = (np.clip(planes, 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+        return np.ascontiguousarray(planes.transpose(1, 2, 0))
+
+    def to_image(self, mode='RGB', background=(255, 255, 255)):
+        """Return the canvas as a PIL image, ``RGB`` ones flattened onto ``background``."""
+        return Image.fromarray(self.to_array(mode, background), mode)
+
+def composite_strips(items, size, out, strip_height, background=(255, 255, 255)):
+    """Composite items into ``out`` one horizontal strip at a time.
+
+    ``out`` is an ``(height, width, 4)`` uint8 RGBX array, typically memory-
+    mapped. Only one strip's canvas is ever held in memory, and only the rows
+    of each layer that fall into the current strip are read.
+    """
+    width, height = size
+    for top in range(0, height, strip_height):
+        bottom = min(height, top + strip_height)
+        strip = Compositor((width, bottom - top))
+        for item in items:
+            item_top, item_bottom = item.position[1], item.position[1] + item.pixels.shape[1]
+            if item_top < bottom and item_bottom > top:
+                strip.paint(item, (0, -top))
+        out[top:bottom, :, :3] = strip.to_array('RGB', background)
+        out[top:bottom, :, 3] = 255
+        del strip
+    return out
@@ -0,0 +1,121 @@
+import os
+import time
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import event, exc
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool, QueuePool
+from utils.metrics import metrics
+
+# Name of the Flask-SQLAlchemy bind used for read-only queries
+REPLICA_BIND = 'replica'
+
+class InstrumentedQueuePool(QueuePool):
+    """``QueuePool`` that records how long callers wait for a connection.
+
+    The wait covers both queueing behind other checkouts when the pool is
+    exhausted and opening a new connection when it is not.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.inc('db_pool_timeouts_total')
+            raise
+        finally:
+            metrics.observe('db_pool_wait_seconds', time.perf_counter() - start)
+
+def engine_options(database_url, env=os.environ):
+    """SQLAlchemy engine options for ``database_url``, tuned by environment variables.
+
+    Pooling applies to server databases only; SQLite picks its own pool.
+    Pre-ping and a recycle age shorter than the proxy's idle timeout keep
+    dropped idle connections from failing the first request after a pause.
+    """
+    if not database_url or database_url.startswith('sqlite'):
+        return {}
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(env.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(env.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(env.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(env.get('DB_POOL_RECYCLE', 280)),
+        'pool_pre_ping': env.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+    if database_url.startswith('postgresql'):
+        connect_args = {'connect_timeout': int(env.get('DB_CONNECT_TIMEOUT', 10))}
+        statement_timeout = int(env.get('DB_STATEMENT_TIMEOUT_MS', 30000))
+        if statement_timeout > 0:
+            connect_args['options'] = f'-c statement_timeout={statement_timeout}'
+        options['connect_args'] = connect_args
+    return options
+
+@event.listens_for(Pool, 'connect')
+def _count_connect(dbapi_connection, connection_record):
+    metrics.inc('db_pool_connections_total')
+
+@event.listens_for(Pool, 'checkout')
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.inc('db_pool_checkouts_total')
+    connection_record.info['checked_out_at'] = time.perf_counter()
+
+@event.listens_for(Pool, 'checkin')
+def _count_checkin(dbapi_connection, connection_record):
+    started = connection_record.info.pop('checked_out_at', None)
+    if started is not None:
+        metrics.observe('db_connection_hold_seconds', time.perf_counter() - started)
+
+@event.listens_for(Pool, 'invalidate')
+def _count_invalidate(dbapi_connection, connection_record, exception):
+    metrics.inc('db_pool_invalidations_total')
+
+def replica_engine(db):
+    """Engine of the read replica, or None when no replica is configured."""
+    if REPLICA_BIND not in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+        return None
+    return db.get_engine(bind=REPLICA_BIND)
+
+@contextmanager
+def read_session(db):
+    """Session for read-only listing queries, on the replica when there is one.
+
+    Objects loaded through it are detached when the block ends, so only
+    attributes loaded by the query itself can be read afterwards.
+    """
+    engine = replica_engine(db)
+    if engine is None:
+        yield db.session
+        return
+    session = Session(bind=engine)
+    try:
+        yield session
+    finally:
+        session.close()
+
+def pool_gauges(db):
+    """``(name, labels, value)`` gauges describing each engine's pool, for ``/metrics``."""
+    engines = {'primary': db.engine}
+    replica = replica_engine(db)
+    if replica is not None:
+        engines[REPLICA_BIND] = replica
+    gauges = []
+    for bind, engine in engines.items():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        gauges += [
+            ('db_pool_size', {'bind': bind}, pool.size()),
+            ('db_pool_checked_out', {'bind': bind}, pool.checkedout()),
+            ('db_pool_overflow', {'bind': bind}, max(pool.overflow(), 0)),
+            ('db_pool_idle', {'bind': bind}, pool.checkedin()),
+        ]
+    return gauges
+
+metrics.describe('db_pool_wait_seconds', 'Time spent waiting for a pooled database connection.')
+metrics.describe('db_connection_hold_seconds', 'Time a database connection stays checked out.')
+metrics.describe('db_pool_timeouts_total', 'Connection checkouts that timed out waiting for the pool.')
+metrics.describe('db_pool_connections_total', 'New database connections opened.')
+metrics.describe('db_pool_checkouts_total', 'Connections checked out of the pool.')
+metrics.describe('db_pool_invalidations_total', 'Connections discarded, e.g. after a failed pre-ping.')
@@ -1,17 +1,49 @@
-from psd_tools import PSDImage
-import cv2
-import numpy as np
-from PIL import Image
 import os
 import base64
+import struct
+import threading
 from io import BytesIO
+from utils.smart_crop import SmartCropper
+from utils.thumbnails import build_pyramid
+from utils.metrics import metrics
+from utils.lazy_import import lazy_import
+
+Image = lazy_import('PIL.Image')
+psd_tools = lazy_import('psd_tools')
+
+# Shared so saliency analyses are reused across calls
+smart_cropper = SmartCropper()
 
 class DocumentProcessor:
     @staticmethod
-    def process_document(filepath):
+    def process_document(filepath, cache=None, blobs=None):
+        """Parse a document into layer dicts.
+        
+        With a ``BlobStore`` in ``blobs``, pixel layers also get a thumbnail
+        pyramid; the document's own pyramid is kept in the parse cache.
+        Cached layers parsed without ``blobs`` get their pyramids the first
+        time ``blobs`` is passed.
+        """
         try:
             if filepath.endswith('.psd'):
-                return DocumentProcessor._process_psd(filepath)
+                if cache is None:
+                    with metrics.timer('psd_parse'):
+                        layers = DocumentProcessor._process_psd(filepath)
+                    if blobs is not None:
+                        DocumentProcessor._build_thumbnails(filepath, layers, None, blobs)
+                    return layers
+                key = cache.file_key(filepath)
+                layers = cache.get_layers(key)
+                metrics.cache('parse', layers is not None)
+                if layers is None:
+                    with metrics.timer('psd_parse'):
+                        layers = DocumentProcessor._process_psd(filepath)
+                elif blobs is None or cache.get_thumbnails(key) is not None:
+                    return layers
+                if blobs is not None:
+                    cache.put_thumbnails(key, DocumentProcessor._build_thumbnails(filepath, layers, cache, blobs))
+                cache.put_layers(key, layers)
+                return layers
             elif filepath.endswith('.indd'):
                 return DocumentProcessor._process_indd(filepath)
             else:
@@ -19,29 +51,39 @@ class DocumentProcessor:
         except Exception as e:
             return {'error': str(e)}
 
-    def process_file(self, filepath):
+    def process_file(self, filepath, cache=None, blobs=None):
         """Process a file and return its layers.
         
         Args:
             filepath (str): Path to the file to process
+            cache (ParseCache, optional): Parse cache to read from and fill
+            blobs (BlobStore, optional): Where to store thumbnail pyramids
             
         Returns:
             list: List of layer dictionaries or error dictionary
         """
-        return DocumentProcessor.process_document(filepath)
+        return DocumentProcessor.process_document(filepath, cache, blobs)
 
     @staticmethod
     def _process_psd(filepath):
-        psd = PSDImage.open(filepath)
+        """Parse a PSD into layer metadata only.
+
+        Pixel data is not touched here; use ``LayerRasterizer`` to
+        rasterize individual layers when they are actually needed.
+        """
+        psd = psd_tools.PSDImage.open(filepath)
         layers = []
         
         for layer in psd:
             layer_data = {
                 'id': str(layer.layer_id),
                 'name': layer.name,
+                'kind': layer.kind,
                 'type': 'image' if layer.kind == 'pixel' else 'text',
                 'visible': layer.visible,
                 'locked': False,  # Initialize locked state
+                'opacity': round(layer.opacity / 255, 4),
+                'blend_mode': layer.blend_mode.name.lower(),
                 'bounds': {
                     'x': layer.offset[0],
                     'y': layer.offset[1],
@@ -50,19 +92,21 @@ class DocumentProcessor:
                 }
             }
             
-            if layer.kind == 'pixel':
-                pil_img = layer.topil()
-                # Store the PIL image for processing
-                layer_data['pil_image'] = pil_img
-                # Store base64 encoded image for JSON serialization
-                buffered = BytesIO()
-                pil_img.save(buffered, format="PNG")
-                img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                layer_data['content'] = {
-                    'format': pil_img.mode,
-                    'size': pil_img.size,
-                    'data': img_str
+            if layer.has_mask() and not layer.mask.disabled and layer.mask.width and layer.mask.height:
+                # Mask pixels are rasterized lazily by LayerRasterizer
+                layer_data['mask'] = {
+                    'bounds': {
+                        'x': layer.mask.left,
+                        'y': layer.mask.top,
+                        'width': layer.mask.width,
+                        'height': layer.mask.height
+                    },
+                    'default': layer.mask.background_color
                 }
+            
+            if layer.kind == 'pixel':
+                # Pixels are rasterized lazily by LayerRasterizer
+                layer_data['has_pixels'] = True
             elif layer.kind == 'type':
                 layer_data['text'] = layer.text_data.text if layer.text_data else ''
                 layer_data['font'] = layer.text_data.font if layer.text_data else 'Arial'
@@ -73,6 +117,38 @@ class DocumentProcessor:
             
         return layers
 
+    @staticmethod
+    def _build_thumbnails(filepath, layers, cache, blobs):
+        """Add a thumbnail pyramid to every pixel layer and return the document's.
+        
+        Layers are rasterized one at a time and dropped again, which also
+        fills the parse cache's bitmaps ahead of the first edit or export.
+        """
+        rasterizer = LayerRasterizer(filepath, cache)
+        for layer in layers:
+            if not layer.get('has_pixels'):
+                continue
+            pyramid = build_pyramid(rasterizer.get_image(layer['id']), blobs)
+            if pyramid:
+                layer['thumbnails'] = pyramid
+            rasterizer.evict(layer['id'])
+        return build_pyramid(rasterizer.get_document_image(), blobs)
+
+    @staticmethod
+    def document_size(filepath):
+        """Return a PSD's ``(width, height)`` from its header, without parsing it."""
+        if not filepath.endswith('.psd'):
+            return None
+        try:
+            with open(filepath, 'rb') as f:
+                header = f.read(26)
+        except OSError:
+            return None
+        if len(header) < 26 or header[:4] != b'8BPS':
+            return None
+        height, width = struct.unpack('>II', header[14:22])
+        return width, height
+
     @staticmethod
     def _process_indd(filepath):
         # Placeholder for InDesign processing
@@ -91,8 +167,15 @@ class DocumentProcessor:
             return 'unknown'
 
     @staticmethod
-    def smart_crop_image(image, target_size):
-        """Smartly crop an image while preserving important content."""
+    def smart_crop_image(image, target_size, cache_key=None):
+        """Smartly crop an image while preserving important content.
+        
+        Args:
+            image: PIL image, base64 string or ``{'data': ...}`` content dict
+            target_size (tuple): Output ``(width, height)``
+            cache_key (str, optional): Stable id of the image (e.g. a blob id)
+                so its saliency analysis is reused across target sizes
+        """
         # Handle both PIL Image and base64 encoded image
         if isinstance(image, str):
             # Decode base64 string
@@ -103,47 +186,103 @@ class DocumentProcessor:
             img_data = base64.b64decode(image['data'])
             image = Image.open(BytesIO(img_data))
         
-        # Convert to numpy array for OpenCV processing
-        img_array = np.array(image)
-        
-        # Convert to grayscale for edge detection
-        if len(img_array.shape) == 3:
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-        else:
-            gray = img_array
-        
-        # Detect edges
-        edges = cv2.Canny(gray, 100, 200)
-        
-        # Find contours
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if not contours:
-            return image.resize(target_size, Image.Resampling.LANCZOS)
-        
-        # Find the largest contour
-        largest_contour = max(contours, key=cv2.contourArea)
-        x, y, w, h = cv2.boundingRect(largest_contour)
-        
-        # Calculate aspect ratio
-        target_ratio = target_size[0] / target_size[1]
-        current_ratio = w / h
-        
-        if current_ratio > target_ratio:
-            # Image is wider than target
-            new_width = int(h * target_ratio)
-            x = x + (w - new_width) // 2
-            w = new_width
-        else:
-            # Image is taller than target
-            new_height = int(w / target_ratio)
-            y = y + (h - new_height) // 2
-            h = new_height
-        
-        # Crop and resize
-        cropped = image.crop((x, y, x + w, y + h))
-        return cropped.resize(target_size, Image.Resampling.LANCZOS)
+        return smart_cropper.crop(image, target_size, cache_key)
+
+class LayerRasterizer:
+    """Rasterize PSD layers on demand, caching the result per layer.
+
+    The PSD is only opened the first time a layer's pixels are requested,
+    and each layer's PIL image is cached so repeated requests are free.
+    When a ``ParseCache`` is given, rasterized bitmaps are also persisted
+    there and the PSD is never decoded for layers already on disk.
+    """
+
+    def __init__(self, filepath, cache=None):
+        self.filepath = filepath
+        self.cache = cache
+        self._cache_key = None
+        self._psd = None
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._psd is None:
+            self._psd = psd_tools.PSDImage.open(self.filepath)
+        return self._psd
+
+    def _find_layer(self, layer_id):
+        for layer in self._open().descendants():
+            if str(layer.layer_id) == str(layer_id):
+                return layer
+        return None
+
+    def get_image(self, layer_id):
+        """Return the PIL image for a pixel layer, or None if it has no pixels."""
+        layer_id = str(layer_id)
+        with self._lock:
+            if layer_id not in self._images:
+                self._images[layer_id] = self._load_image(layer_id)
+            return self._images[layer_id]
+
+    def _load_image(self, layer_id):
+        if self.cache is not None:
+            if self._cache_key is None:
+                self._cache_key = self.cache.file_key(self.filepath)
+            image = self.cache.get_bitmap(self._cache_key, layer_id)
+            metrics.cache('bitmap', image is not None)
+            if image is not None:
+                return image
+        layer = self._find_layer(layer_id)
+        if layer is None or layer.kind != 'pixel':
+            return None
+        with metrics.timer('rasterize'):
+            image = layer.topil()
+        if self.cache is not None and image is not None:
+            self.cache.put_bitmap(self._cache_key, layer_id, image)
+        return image
+
+    def get_document_image(self):
+        """Return the document's merged image, compositing layers only when the file stores none."""
+        psd = self._open()
+        with metrics.timer('rasterize'):
+            return psd.topil() if psd.has_preview() else psd.composite()
+
+    def get_mask(self, layer_id):
+        """Return a layer's mask as an ``L`` image, or None if it has none."""
+        key = f'{layer_id}.mask'
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = self._load_mask(str(layer_id))
+            return self._images[key]
+
+    def _load_mask(self, layer_id):
+        key = f'{layer_id}.mask'
+        if self.cache is not None:
+            if self._cache_key is None:
+                self._cache_key = self.cache.file_key(self.filepath)
+            image = self.cache.get_bitmap(self._cache_key, key)
+            if image is not None:
+                return image
+        layer = self._find_layer(layer_id)
+        if layer is None or not layer.has_mask():
+            return None
+        image = layer.mask.topil()
+        if image is None:
+            return None
+        image = image.convert('L')
+        if self.cache is not None:
+            self.cache.put_bitmap(self._cache_key, key, image)
+        return image
+
+    def evict(self, layer_id=None):
+        """Drop cached pixels for one layer, or for all layers."""
+        with self._lock:
+            if layer_id is None:
+                self._images.clear()
+            else:
+                self._images.pop(str(layer_id), None)
+                self._images.pop(f'{layer_id}.mask', None)
 
-def process_document(filepath):
+def process_document(filepath, cache=None, blobs=None):
     """Public interface for document processing."""
-    return DocumentProcessor.process_document(filepath) 
\ No newline at end of file
+    return DocumentProcessor.process_document(filepath, cache, blobs) 
\ No newline at end of file
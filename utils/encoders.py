@@ -0,0 +1,127 @@
+import os
+import time
+from io import BytesIO
+from utils.metrics import metrics
+
+# zlib level for PNGs only the app reads back: layer blobs, parse cache, preview tiles
+INTERMEDIATE_COMPRESS_LEVEL = 1
+
+class EncoderError(ValueError):
+    """Raised for output formats or encoder settings that are not supported."""
+
+class Encoder:
+    """How one output format is written.
+
+    ``png`` takes a zlib ``compress_level`` (0-9) and ``optimize``; ``jpg``
+    and ``webp`` a ``quality`` (1-100); ``webp-lossless`` uses ``quality``
+    as effort, trading encode time for size. Specs are either such a name,
+    optionally followed by ``:<level>`` (e.g. ``jpg:80``, ``png:9``), or a
+    dict like ``{'format': 'webp', 'quality': 70}``.
+    """
+
+    DEFAULTS = {
+        'png': {'compress_level': 6},
+        'jpg': {'quality': 90},
+        'webp': {'quality': 85},
+        'webp-lossless': {'quality': 50},
+    }
+    ALIASES = {'jpeg': 'jpg'}
+    PIL_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP', 'webp-lossless': 'WEBP'}
+
+    def __init__(self, name='png', quality=None, compress_level=None, optimize=False):
+        name = self.ALIASES.get(name.lower(), name.lower())
+        if name not in self.DEFAULTS:
+            raise EncoderError(f'Unsupported format: {name}')
+        self.name = name
+        defaults = self.DEFAULTS[name]
+        if name == 'png':
+            self.options = {'compress_level': self._level(compress_level, defaults['compress_level'], 0, 9)}
+            if optimize:
+                self.options['optimize'] = True
+        else:
+            self.options = {'quality': self._level(quality, defaults['quality'], 1, 100)}
+            if name == 'jpg':
+                self.options['optimize'] = bool(optimize)
+            elif name == 'webp-lossless':
+                self.options['lossless'] = True
+
+    @staticmethod
+    def _level(value, default, low, high):
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise EncoderError(f'Invalid level: {value!r}')
+        if not low <= value <= high:
+            raise EncoderError(f'Level {value} is outside {low}-{high}')
+        return value
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Build an encoder from a format name, ``name:level`` or a settings dict."""
+        if isinstance(spec, Encoder):
+            return spec
+        if isinstance(spec, dict):
+            settings = dict(spec)
+            name = settings.pop('format', 'png')
+            unknown = set(settings) - {'quality', 'compress_level', 'optimize'}
+            if unknown:
+                raise EncoderError(f"Unknown encoder settings: {', '.join(sorted(unknown))}")
+            return cls(str(name), **settings)
+        name, _, level = str(spec).partition(':')
+        if not level:
+            return cls(name)
+        if cls.ALIASES.get(name.lower(), name.lower()) == 'png':
+            return cls(name, compress_level=level)
+        return cls(name, quality=level)
+
+    @classmethod
+    def from_specs(cls, specs):
+        """Encoders for a list of specs, dropping ones with identical settings."""
+        encoders = {}
+        for spec in specs:
+            encoder = cls.from_spec(spec)
+            encoders.setdefault(encoder.key, encoder)
+        return list(encoders.values())
+
+    @property
+    def extension(self):
+        return 'webp' if self.name == 'webp-lossless' else self.name
+
+    @property
+    def pil_format(self):
+        return self.PIL_FORMATS[self.name]
+
+    @property
+    def key(self):
+        """Short string identifying the exact settings, e.g. ``png-compress_level6``."""
+        return '-'.join([self.name] + [f'{option}{int(value)}' for option, value in sorted(self.options.items())])
+
+    def save(self, image, fp):
+        """Write ``image`` to a path or file object."""
+        image.save(fp, format=self.pil_format, **self.options)
+
+    def encode(self, image):
+        """Return ``image`` encoded as bytes."""
+        buffered = BytesIO()
+        start = time.perf_counter()
+        self.save(image, buffered)
+        self.record(time.perf_counter() - start, buffered.tell())
+        return buffered.getvalue()
+
+    def save_file(self, image, path):
+        """Write ``image`` to ``path``, returning ``(seconds, bytes)``."""
+        start = time.perf_counter()
+        self.save(image, path)
+        seconds = time.perf_counter() - start
+        size = os.path.getsize(path)
+        self.record(seconds, size)
+        return seconds, size
+
+    def record(self, seconds, size):
+        """Account one encoded output in the stage timings and byte counters."""
+        metrics.observe('pipeline_stage_seconds', seconds, stage='export_encode', format=self.name)
+        metrics.inc('encoded_bytes_total', size, format=self.name)
+
+metrics.describe('encoded_bytes_total', 'Bytes of encoded output images, by format.')
@@ -0,0 +1,112 @@
+import os
+import time
+import shutil
+import logging
+import threading
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class ExportCache:
+    """Size-bounded LRU over the rendered files in the exports folder.
+
+    Exports are named after their render key (see ``LayerManager.render_key``),
+    so an existing file already shows exactly what a new export with the same
+    key would render. A file's mtime records when it was last used; once the
+    folder grows past ``max_bytes`` the least recently used files are removed.
+
+    Variant directories written by the variant engine count towards the same
+    total and are evicted whole. A directory without its ``manifest.json`` is
+    still being written and is left alone, unless nothing has been added to
+    it for ``ABANDONED_SECONDS``.
+    """
+
+    ABANDONED_SECONDS = 24 * 3600
+
+    def __init__(self, root, max_bytes=2 * 1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_app(cls, app):
+        """Build the cache configured for a Flask app."""
+        return cls(
+            os.path.join(app.config['UPLOAD_FOLDER'], 'exports'),
+            app.config.get('EXPORT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024)
+        )
+
+    def lookup(self, path):
+        """Return whether ``path`` was already rendered, marking it recently used."""
+        try:
+            os.utime(path, None)
+            hit = os.path.isfile(path)
+        except OSError:
+            hit = False
+        metrics.cache('export', hit)
+        return hit
+
+    def size(self):
+        """Return the total size of the cached exports in bytes."""
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return entries
+        for name in names:
+            # Dot files are exports still being written
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if os.path.isfile(path):
+                entries.append((stat.st_mtime, path, stat.st_size))
+            elif os.path.isdir(path):
+                if not os.path.exists(os.path.join(path, 'manifest.json')) \
+                        and time.time() - stat.st_mtime < self.ABANDONED_SECONDS:
+                    continue
+                entries.append((stat.st_mtime, path, self._directory_size(path)))
+        return entries
+
+    @staticmethod
+    def _directory_size(path):
+        size = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return size
+
+    def evict(self, keep=()):
+        """Remove least-recently-used exports until the folder fits ``max_bytes``.
+
+        Paths in ``keep``, e.g. the exports being returned to a caller or a
+        variant directory just written, are never removed.
+        """
+        keep = {os.path.abspath(path) for path in keep}
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, _, size in entries)
+            for _, path, size in entries:
+                if total <= self.max_bytes:
+                    break
+                if os.path.abspath(path) in keep:
+                    continue
+                logger.debug(f"Evicting export {path}")
+                try:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                except OSError:
+                    continue
+                total -= size
@@ -0,0 +1,20 @@
+from gevent import monkey, socket
+from gunicorn.workers.ggevent import GeventWorker as _GeventWorker
+
+class GeventWorker(_GeventWorker):
+    """Gunicorn gevent worker that leaves threads native.
+
+    Sockets, ``select`` and ``time.sleep`` become cooperative as usual, but
+    ``threading`` is not patched. Rendering offloaded to native threads
+    (``utils.offload``) shares locks with request greenlets, and a patched
+    lock contended from a native thread can lose its wakeup. The app's locks
+    only guard in-memory state and are never held across I/O, so leaving
+    them native does not block the event loop.
+    """
+
+    def patch(self):
+        monkey.patch_all(thread=False)
+        self.sockets = [
+            socket.socket(s.FAMILY, socket.SOCK_STREAM, fileno=s.sock.detach())
+            for s in self.sockets
+        ]
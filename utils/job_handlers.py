@@ -0,0 +1,77 @@
+from flask import current_app
+from extensions import db
+from models import Layer
+from utils.blob_store import BlobStore
+from utils.document_processor import DocumentProcessor
+from utils.job_queue import JobQueue, job_handler
+from utils.layer_manager import LayerManager
+from utils.layer_session import LayerSession, SessionRegistry
+from utils.metrics import metrics
+from utils.variant_engine import VariantEngine
+
+@job_handler('process_document')
+def process_document_job(payload, progress):
+    """Parse an uploaded document, filling the parse cache and thumbnails for the web process."""
+    cache = SessionRegistry.for_app(current_app).cache
+    if payload.get('sha256'):
+        # Hashed while streaming in, no need to read the file again
+        cache.remember_hash(payload['filepath'], payload['sha256'])
+    progress(0.1)
+    layers = DocumentProcessor.process_document(payload['filepath'], cache, BlobStore.for_app(current_app))
+    if isinstance(layers, dict) and 'error' in layers:
+        return layers
+    if payload.get('project_file_id'):
+        # Replace the file's layer rows in one bulk insert
+        progress(0.9)
+        Layer.query.filter_by(project_file_id=payload['project_file_id']).delete()
+        Layer.bulk_create(payload['project_file_id'], layers)
+        with metrics.timer('db_save'):
+            db.session.commit()
+    return {'filepath': payload['filepath'], 'file_id': payload.get('project_file_id'), 'layers': layers}
+
+@job_handler('export_document')
+def export_document_job(payload, progress):
+    """Render exports from a snapshot of a layer session."""
+    registry = SessionRegistry.for_app(current_app)
+    session = LayerSession.from_dict(payload['session'], registry.cache)
+    # Layers unchanged since this worker's last export of the session are not prepared again
+    session.render_cache = registry.render_cache(session)
+    manager = LayerManager(session=session)
+    return manager.export_documents(payload['sizes'], payload.get('formats', ['png']), progress)
+
+@job_handler('render_variant')
+def render_variant_job(payload, progress):
+    """Export one variant of a template, with some layers' content substituted."""
+    registry = SessionRegistry.for_app(current_app)
+    if 'shared_session' in payload:
+        session_data = JobQueue.for_app(current_app).shared(payload['shared_session'])
+        if session_data is None:
+            return {'success': False, 'error': 'The batch this variant belongs to is gone'}
+    else:
+        session_data = payload['session']
+    manager = LayerManager(session=LayerSession.from_dict(session_data, registry.cache))
+    for layer_id, value in payload['substitution'].get('layers', {}).items():
+        layer = manager._layers.get(layer_id)
+        if layer is None:
+            return {'success': False, 'error': f'Layer {layer_id} not found'}
+        result = manager.update_layer(layer_id, value, layer['type'])
+        if not result.get('success'):
+            return {'success': False, 'error': result.get('error') or result.get('message')}
+    return manager.export_documents(payload['sizes'], payload['formats'], progress)
+
+@job_handler('generate_variants')
+def generate_variants_job(payload, progress):
+    """Render a substitution table into a directory of variants."""
+    registry = SessionRegistry.for_app(current_app)
+    session = LayerSession.from_dict(payload['session'], registry.cache)
+    engine = VariantEngine(LayerManager(session=session), current_app.config.get('EXPORT_WORKERS'))
+    manifest = engine.write_directory(
+        payload['rows'], payload['sizes'], payload['formats'], payload['directory'],
+        progress, len(payload['rows'])
+    )
+    return {
+        'success': True,
+        'directory': payload['directory'],
+        'rendered': sum(1 for entry in manifest if 'error' not in entry),
+        'failed': [entry for entry in manifest if 'error' in entry]
+    }
@@ -0,0 +1,364 @@
+import os
+import json
+import signal
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import traceback
+import multiprocessing
+from contextlib import closing
+from datetime import datetime, timedelta
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Registered job handlers, filled in by utils.job_handlers
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    """Register a function as the handler for jobs of ``kind``.
+
+    Handlers are called as ``handler(payload, progress)`` inside an app
+    context, where ``progress(fraction)`` records completion between 0 and 1.
+    Whatever they return must be JSON-serializable and becomes the job result.
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+class JobQueue:
+    """Job queue backed by a local SQLite database.
+
+    Any process can submit jobs or poll their status. Worker processes
+    claim queued jobs atomically, so several web and worker processes can
+    share one queue file.
+
+    A running job holds a lease that its worker renews every few seconds
+    (``heartbeat_at``). When a worker dies mid-job the lease runs out after
+    ``lease_seconds`` and the next ``claim`` queues the job again, or fails
+    it once it has been attempted ``max_attempts`` times.
+
+    Data that many jobs need, such as the template of a batch, is stored
+    once with ``share`` and its id put in the payloads instead.
+    """
+
+    # Shared data left behind by a submitter that died is dropped after this long
+    SHARED_MAX_AGE = 24 * 3600
+
+    def __init__(self, db_path, lease_seconds=60, max_attempts=2):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._workers = []
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    payload TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at TEXT,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    heartbeat_at TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            # Queue files created before jobs had leases
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'heartbeat_at' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN heartbeat_at TEXT')
+            if 'attempts' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status_created ON jobs (status, created_at)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS shared (
+                    id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    created_at TEXT
+                )
+            ''')
+
+    @classmethod
+    def for_app(cls, app):
+        """Return the job queue bound to a Flask app, creating it on first use."""
+        queue = app.extensions.get('job_queue')
+        if queue is None:
+            queue = cls(
+                app.config.get('JOB_QUEUE_PATH', os.path.join(app.config['UPLOAD_FOLDER'], 'jobs.sqlite3')),
+                app.config.get('JOB_LEASE_SECONDS', 60),
+                app.config.get('JOB_MAX_ATTEMPTS', 2)
+            )
+            app.extensions['job_queue'] = queue
+        return queue
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def submit(self, kind, payload):
+        """Queue a job and return its id."""
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, status, payload, created_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, kind, 'queued', json.dumps(payload), datetime.utcnow().isoformat())
+            )
+        return job_id
+
+    def share(self, data):
+        """Store data that the payloads of several jobs refer to and return its id.
+
+        The submitter removes it with ``unshare`` once its jobs are done.
+        """
+        shared_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'DELETE FROM shared WHERE created_at < ?',
+                ((now - timedelta(seconds=self.SHARED_MAX_AGE)).isoformat(),)
+            )
+            conn.execute(
+                'INSERT INTO shared (id, data, created_at) VALUES (?, ?, ?)',
+                (shared_id, json.dumps(data), now.isoformat())
+            )
+        return shared_id
+
+    def shared(self, shared_id):
+        """Return data stored with ``share``, or None if it was removed."""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT data FROM shared WHERE id = ?', (shared_id,)).fetchone()
+        return json.loads(row['data']) if row is not None else None
+
+    def unshare(self, shared_id):
+        with closing(self._connect()) as conn:
+            conn.execute('DELETE FROM shared WHERE id = ?', (shared_id,))
+
+    def all_shared(self):
+        """Return all data currently stored with ``share``."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT data FROM shared').fetchall()
+        return [json.loads(row['data']) for row in rows]
+
+    def get(self, job_id):
+        """Return a job as a dict, or None if it does not exist."""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._decode(row) if row is not None else None
+
+    @staticmethod
+    def _decode(row):
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else None
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def with_status(self, status):
+        """Return all jobs with ``status``, as dicts."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT * FROM jobs WHERE status = ?', (status,)).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def get_many(self, job_ids):
+        """Return the jobs with the given ids, as dicts, skipping unknown ids."""
+        if not job_ids:
+            return []
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))})", list(job_ids)
+            ).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def cancel(self, job_ids):
+        """Cancel jobs that are still queued; running ones finish normally."""
+        if not job_ids:
+            return
+        with closing(self._connect()) as conn:
+            conn.execute(
+                f"UPDATE jobs SET status = 'cancelled', finished_at = ? "
+                f"WHERE status = 'queued' AND id IN ({', '.join('?' * len(job_ids))})",
+                [datetime.utcnow().isoformat()] + list(job_ids)
+            )
+
+    def counts(self):
+        """Number of jobs in each status."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status').fetchall()
+        return {row['status']: row['count'] for row in rows}
+
+    def set_progress(self, job_id, progress):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'UPDATE jobs SET progress = ?, heartbeat_at = ? WHERE id = ?',
+                (max(0.0, min(1.0, progress)), datetime.utcnow().isoformat(), job_id)
+            )
+
+    def heartbeat(self, job_id):
+        """Renew the lease on a running job."""
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'",
+                (datetime.utcnow().isoformat(), job_id)
+            )
+
+    def _reclaim_stale(self, conn):
+        """Requeue or fail running jobs whose lease has run out. Call inside a write transaction."""
+        cutoff = (datetime.utcnow() - timedelta(seconds=self.lease_seconds)).isoformat()
+        stale = conn.execute(
+            "SELECT id, attempts FROM jobs WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ?",
+            (cutoff,)
+        ).fetchall()
+        for row in stale:
+            if row['attempts'] >= self.max_attempts:
+                logger.warning(f"Job {row['id']} lost its worker {row['attempts']} times, giving up")
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    ('Job worker stopped responding', datetime.utcnow().isoformat(), row['id'])
+                )
+            else:
+                logger.warning(f"Job {row['id']} lost its worker, queueing it again")
+                conn.execute("UPDATE jobs SET status = 'queued', progress = 0 WHERE id = ?", (row['id'],))
+
+    def claim(self):
+        """Atomically move the oldest queued job to running and return it."""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            self._reclaim_stale(conn)
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            now = datetime.utcnow().isoformat()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (now, now, row['id'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return self.get(row['id'])
+
+    def run(self, job, metrics_folder=None):
+        """Execute a claimed job with its registered handler and store the outcome.
+
+        With ``metrics_folder`` set, this process's metrics are dumped there
+        when the job starts and when it ends, so ``/metrics`` shows it in flight.
+        """
+        handler = JOB_HANDLERS.get(job['kind'])
+        metrics.gauge('jobs_in_flight', 1, kind=job['kind'])
+        _dump_metrics(metrics_folder)
+        start = time.perf_counter()
+        done = threading.Event()
+        # Renews the lease while the handler works, even if it never reports progress
+        heartbeat = threading.Thread(target=self._keep_alive, args=(job['id'], done), daemon=True)
+        heartbeat.start()
+        try:
+            if handler is None:
+                raise ValueError(f"No handler registered for job kind '{job['kind']}'")
+            result = handler(job['payload'], lambda fraction: self.set_progress(job['id'], fraction))
+            status, error = 'finished', None
+            if isinstance(result, dict) and ('error' in result or result.get('success') is False):
+                status, error = 'failed', result.get('error') or result.get('message')
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {traceback.format_exc()}")
+            result, status, error = None, 'failed', str(e)
+        finally:
+            done.set()
+            heartbeat.join()
+            metrics.gauge('jobs_in_flight', -1, kind=job['kind'])
+        metrics.observe('job_seconds', time.perf_counter() - start, kind=job['kind'])
+        metrics.inc('jobs_total', kind=job['kind'], status=status)
+        with closing(self._connect()) as conn:
+            # Skipped if the lease ran out and another worker took the job over
+            conn.execute(
+                "UPDATE jobs SET status = ?, progress = ?, result = ?, error = ?, finished_at = ? "
+                "WHERE id = ? AND status = 'running' AND attempts = ?",
+                (status, 1.0, json.dumps(result), error, datetime.utcnow().isoformat(), job['id'], job['attempts'])
+            )
+        _dump_metrics(metrics_folder)
+
+    def _keep_alive(self, job_id, done):
+        while not done.wait(self.lease_seconds / 4):
+            try:
+                self.heartbeat(job_id)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not renew the lease on job {job_id}: {e}")
+
+    def start_workers(self, app, count, daemon=True):
+        """Fork ``count`` worker processes polling this queue, if not already running."""
+        self._workers = [p for p in self._workers if p.is_alive()]
+        ctx = multiprocessing.get_context('fork')
+        while len(self._workers) < count:
+            process = ctx.Process(
+                target=run_worker,
+                args=(app, self.db_path, app.config.get('JOB_POLL_INTERVAL', 0.5)),
+                daemon=daemon
+            )
+            process.start()
+            self._workers.append(process)
+        return self._workers
+
+def _dump_metrics(folder):
+    if not folder:
+        return
+    try:
+        metrics.dump(folder)
+    except OSError as e:
+        logger.warning(f"Could not write metrics snapshot: {e}")
+
+def run_worker(app, db_path, poll_interval=0.5):
+    """Claim and run jobs forever. Meant to be the target of a worker process."""
+    import utils.job_handlers  # noqa: F401 - registers the handlers
+    from extensions import db
+    queue = JobQueue(db_path, app.config.get('JOB_LEASE_SECONDS', 60), app.config.get('JOB_MAX_ATTEMPTS', 2))
+    metrics_folder = app.config.get('METRICS_FOLDER')
+    # Values inherited from the parent are reported by the parent itself
+    metrics.reset()
+    with app.app_context():
+        # Connections inherited across fork must not be reused
+        try:
+            db.engine.dispose()
+        except Exception:
+            pass
+        logger.info(f"Job worker {os.getpid()} started on {db_path}")
+        while True:
+            job = queue.claim()
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            queue.run(job, metrics_folder)
+
+def register_job_commands(app):
+    """Add the ``flask jobs-worker`` command for running dedicated workers."""
+    import click
+
+    @app.cli.command('jobs-worker')
+    @click.option('--workers', default=os.cpu_count() or 1, help='Number of worker processes.')
+    def jobs_worker(workers):
+        """Run job worker processes in the foreground."""
+        queue = JobQueue.for_app(app)
+        processes = queue.start_workers(app, workers, daemon=False)
+
+        def stop(signum, frame):
+            # Take the workers down too when a supervisor stops this command
+            for process in processes:
+                process.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        for process in processes:
+            process.join()
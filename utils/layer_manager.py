@@ -1,35 +1,136 @@
-from flask import current_app
+from flask import current_app, g
 from utils.document_processor import DocumentProcessor
+from utils.layer_session import SessionRegistry
+from utils.blob_store import BlobStore
+from utils.export_cache import ExportCache
+from utils.encoders import Encoder, EncoderError
+from utils.thumbnails import build_pyramid
+from utils.text_fitter import TextFitter, font_lock, load_font
+from utils.compositor import make_item, composite_strips
+from utils.parse_cache import ParseCache
+from utils.memory_budget import MemoryBudget, COMPOSITE_BYTES_PER_PIXEL, save_rgbx
+from utils.metrics import metrics
 import os
+import re
+import time
 import json
-from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+import uuid
+import hashlib
+from contextlib import contextmanager
 import base64
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.lazy_import import lazy_import
+
+Image = lazy_import('PIL.Image')
+ImageDraw = lazy_import('PIL.ImageDraw')
+
+# Named output sizes accepted by export_document
+EXPORT_SIZES = {
+    'square': (1080, 1080),
+    'landscape': (1920, 1080),
+    'portrait': (1080, 1920)
+}
+
+# Export file names end in the render key of their contents
+EXPORT_NAME = re.compile(r'^output_.+_([0-9a-f]{32})\.\w+$')
+
+def export_key(filename):
+    """Return the render key embedded in an export's file name, or None."""
+    match = EXPORT_NAME.match(filename)
+    return match.group(1) if match else None
+
+@contextmanager
+def _replacing(path):
+    """Yield a temporary path next to ``path`` that replaces it once written.
+
+    Readers never see a partly written export, even while the same file is
+    being rendered again.
+    """
+    folder, name = os.path.split(path)
+    temp = os.path.join(folder, f'.{uuid.uuid4().hex}_{name}')
+    try:
+        yield temp
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
 
 class LayerManager:
-    _instance = None
-    _layers = {}
-    _document = None
+    """Edit and export the layers of one project document.
+
+    Layer state lives in a per-project ``LayerSession`` held by the app's
+    ``SessionRegistry``, so managers for different projects never share a
+    document and an idle project can be evicted and reloaded on demand.
+    """
     
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(LayerManager, cls).__new__(cls)
-        return cls._instance
+    text_fitter = TextFitter()
     
-    def __init__(self):
+    def __init__(self, session_key='default', session=None):
         self.processor = DocumentProcessor()
         self.upload_folder = current_app.config['UPLOAD_FOLDER']
-        self.export_folder = os.path.join(self.upload_folder, 'exports')
-        os.makedirs(self.export_folder, exist_ok=True)
+        self.exports = ExportCache.from_app(current_app)
+        self.export_folder = self.exports.root
+        # An explicit session (e.g. a snapshot shipped to a job worker) bypasses the registry
+        if session is None:
+            # Kept in memory until the app context ends, see release_sessions
+            session = SessionRegistry.for_app(current_app).get(session_key, pin=True)
+            g.setdefault('pinned_sessions', []).append(session.key)
+        self.session = session
+        self.blobs = BlobStore.for_app(current_app)
     
-    @classmethod
-    def load_document(cls, filepath):
+    @property
+    def _layers(self):
+        return self.session.layers
+    
+    @property
+    def _document(self):
+        return self.session.document
+    
+    @property
+    def _rasterizer(self):
+        return self.session.rasterizer
+    
+    def load_document(self, filepath):
         """Load a document and initialize layers."""
-        cls._document = filepath
-        cls._layers = {layer['id']: layer for layer in DocumentProcessor.process_document(filepath)}
+        layers = DocumentProcessor.process_document(filepath, self.session.cache, self.blobs)
+        if isinstance(layers, dict) and 'error' in layers:
+            return layers
+        self.session.load(filepath, layers)
+        return {'success': True, 'layers': list(self._layers.values())}
+    
+    def get_layer_content(self, layer_id, inline=False):
+        """Return a layer's pixel content, rasterizing it on first access.
+        
+        The content is a blob reference; pass ``inline=True`` to also get
+        the base64 PNG ``data`` for sending to a client.
+        """
+        layer = self._layers.get(layer_id)
+        if layer is None:
+            return None
+        if 'content' not in layer:
+            if not layer.get('has_pixels') or self._rasterizer is None:
+                return None
+            image = self._rasterizer.get_image(layer_id)
+            if image is None:
+                return None
+            layer['content'] = self.blobs.put_image(image)
+        return self.blobs.inline(layer['content']) if inline else layer['content']
+    
+    def serialize_layer(self, layer, inline=False):
+        """Return a JSON-ready copy of a layer, optionally with inline base64 pixels."""
+        data = dict(layer)
+        if inline:
+            for key in ('content', 'processed_content'):
+                if key in data:
+                    data[key] = self.blobs.inline(data[key])
+        return data
     
     def update_layer(self, layer_id, content, layer_type):
+        with self.session.lock:
+            return self._update_layer(layer_id, content, layer_type)
+    
+    def _update_layer(self, layer_id, content, layer_type):
         try:
             if layer_id not in self._layers:
                 return {'error': 'Layer not found'}
@@ -44,23 +145,19 @@ class LayerManager:
                 # Auto-adjust text size and position
                 self._adjust_text_layer(layer)
             elif layer_type == 'image':
-                if isinstance(content, dict) and 'data' in content:
+                if isinstance(content, dict) and 'blob_id' in content and self.blobs.exists(content['blob_id']):
                     layer['content'] = content
+                elif isinstance(content, dict) and 'data' in content:
+                    layer['content'] = self.blobs.put_image(self.blobs.load_content(content))
                 else:
-                    # Convert content to our standard format if it's not already
+                    # Raw or base64-encoded image bytes from the client
                     img_data = base64.b64decode(content) if isinstance(content, str) else content
                     img = Image.open(BytesIO(img_data))
-                    buffered = BytesIO()
-                    img.save(buffered, format="PNG")
-                    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                    layer['content'] = {
-                        'format': img.mode,
-                        'size': img.size,
-                        'data': img_str
-                    }
+                    layer['content'] = self.blobs.put_image(img)
                 # Smart crop and resize image
                 self._adjust_image_layer(layer)
             
+            self.session.mark_changed(layer_id)
             return {'success': True, 'layer': layer}
         except Exception as e:
             return {'success': False, 'message': str(e)}
@@ -73,120 +170,303 @@ class LayerManager:
         width = bounds['width']
         height = bounds['height']
         
-        # Create a temporary image to measure text
-        temp_img = Image.new('RGB', (width, height), (255, 255, 255))
-        draw = ImageDraw.Draw(temp_img)
-        
-        # Start with the original font size
-        font_size = layer.get('size', 12)
-        try:
-            font = ImageFont.truetype(layer.get('font', 'Arial'), font_size)
-        except OSError:
+        # Always fit from the document's original size, not a previous fit
+        base_size = layer.setdefault('base_size', layer.get('size', 12))
+        layout = cls.text_fitter.fit(layer['text'], layer.get('font', 'Arial'), base_size, width, height)
+        if layout['is_default']:
             # Fallback to default font if specified font is not available
-            font = ImageFont.load_default()
             layer['font'] = 'default'
         
-        # Measure text
-        text = layer['text']
-        text_width, text_height = draw.textsize(text, font=font)
-        
-        # Adjust font size if needed
-        while (text_width > width * 0.9 or text_height > height * 0.9) and font_size > 8:
-            font_size -= 1
-            try:
-                font = ImageFont.truetype(layer.get('font', 'Arial'), font_size)
-            except OSError:
-                font = ImageFont.load_default()
-            text_width, text_height = draw.textsize(text, font=font)
-        
         # Update layer properties
-        layer['size'] = font_size
+        left, top = layout['bbox'][0], layout['bbox'][1]
+        layer['size'] = layout['size']
+        layer['wrapped_text'] = '\n'.join(layout['lines'])
         layer['position'] = {
-            'x': bounds['x'] + (width - text_width) // 2,
-            'y': bounds['y'] + (height - text_height) // 2
+            'x': bounds['x'] + (width - layout['width']) // 2 - left,
+            'y': bounds['y'] + (height - layout['height']) // 2 - top
         }
     
-    @classmethod
-    def _adjust_image_layer(cls, layer):
+    def _adjust_image_layer(self, layer):
         """Adjust image layer for optimal display."""
         bounds = layer['bounds']
         width = bounds['width']
         height = bounds['height']
         
         # Handle the content based on its format
-        if isinstance(layer['content'], dict) and 'data' in layer['content']:
-            img_data = base64.b64decode(layer['content']['data'])
-            image = Image.open(BytesIO(img_data))
+        if 'content' in layer:
+            image = self.blobs.load_content(layer['content'])
         else:
-            # Fallback for legacy format
-            image = layer.get('pil_image')
-            if not image:
-                return
+            # Original PSD pixels are rasterized on demand
+            image = self._rasterizer.get_image(layer['id']) if self._rasterizer and layer.get('has_pixels') else None
+        if not image:
+            return
         
         # Process the image
-        processed_image = DocumentProcessor.smart_crop_image(image, (width, height))
-        
-        # Convert processed image back to base64 for storage
-        buffered = BytesIO()
-        processed_image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        cache_key = layer.get('content', {}).get('blob_id')
+        processed_image = DocumentProcessor.smart_crop_image(image, (width, height), cache_key)
         
-        # Update layer with processed image
-        layer['processed_content'] = {
-            'format': processed_image.mode,
-            'size': processed_image.size,
-            'data': img_str
-        }
+        # Update layer with a reference to the processed image
+        layer['processed_content'] = self.blobs.put_image(processed_image)
+        layer['thumbnails'] = build_pyramid(processed_image, self.blobs)
     
     def export_document(self, size, format='png'):
+        result = self.export_documents([size], [format])
+        if not result.get('success'):
+            return result
+        return {'success': True, 'path': result['exports'][0]['path']}
+    
+    def export_documents(self, sizes, formats=('png',), progress=None):
+        """Render the document at several sizes and formats in one pass.
+        
+        Targets already rendered from the same document and layer state are
+        returned straight from the exports folder. For the rest, every layer
+        image is decoded and every text layer rendered once, then the targets
+        are rendered in parallel on a thread pool. When the render would
+        not fit under the app's ``JOB_MEMORY_LIMIT``, layers are spilled to disk
+        instead and targets are composited one at a time, in strips.
+        
+        Args:
+            sizes (list): Size names from ``EXPORT_SIZES`` or ``(width, height)`` pairs
+            formats (list): Encoder specs, e.g. ``['png', 'jpg:80', {'format': 'webp', 'quality': 70}]``
+            progress (callable, optional): Called with the completed fraction
+            
+        Returns:
+            dict: ``{'success': True, 'exports': [{'size', 'format', 'options', 'path',
+            'url', 'etag', 'bytes', 'encode_ms', 'cached'}, ...]}``
+        """
         try:
             if not self._document:
                 return {'error': 'No document loaded'}
+            try:
+                encoders = Encoder.from_specs(formats)
+            except EncoderError as e:
+                return {'error': str(e)}
             
-            # Define output sizes
-            sizes = {
-                'square': (1080, 1080),
-                'landscape': (1920, 1080),
-                'portrait': (1080, 1920)
-            }
-            
-            if size not in sizes:
-                return {'error': 'Invalid size specified'}
-            
-            target_size = sizes[size]
-            output_path = os.path.join(self.export_folder, f'output_{size}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{format}')
+            targets = []
+            for size in sizes:
+                if isinstance(size, str):
+                    if size not in EXPORT_SIZES:
+                        return {'error': 'Invalid size specified'}
+                    targets.append((size, EXPORT_SIZES[size]))
+                elif isinstance(size, (list, tuple)) and len(size) == 2:
+                    targets.append((f'{int(size[0])}x{int(size[1])}', (int(size[0]), int(size[1]))))
+                else:
+                    return {'error': 'Invalid size specified'}
             
-            # Create a new image with the target size
-            output = Image.new('RGB', target_size, (255, 255, 255))
+            budget = MemoryBudget.from_app(current_app)
+            with self.session.lock:
+                # The strip renderer writes different bytes for the same pixels, so it is decided
+                # up front and named in the key
+                bounded = not budget.fits(self._estimate_export_bytes(list(dict(targets).values())))
+                # Named by what they show, so identical renders share a file and an ETag
+                state = self._render_state()
+                jobs = []
+                for name, target_size in dict(targets).items():
+                    for encoder in encoders:
+                        key = self.render_key(state, target_size, encoder.key, 'strips' if bounded else 'memory')
+                        output_path = os.path.join(self.export_folder, f'output_{name}_{key}.{encoder.extension}')
+                        jobs.append((name, encoder, target_size, output_path))
+                # Exports rendered before from the same state are returned as they are
+                stats = {}
+                for _, _, _, output_path in jobs:
+                    if self.exports.lookup(output_path):
+                        stats[output_path] = (None, os.path.getsize(output_path))
+                pending = [job for job in jobs if job[3] not in stats]
+                if not pending:
+                    return {'success': True, 'exports': self._export_entries(jobs, stats)}
+                prepared = self._prepare_bounded_layers(budget) if bounded else self._prepare_export_layers()
+                revisions = dict(self.session.layer_revisions)
+                focus_id = self.session.changes[-1][1] if self.session.changes else None
             
-            # Process and place each layer
-            for layer in self._layers.values():
-                if not layer['visible']:
-                    continue
-                
-                if layer['type'] == 'text':
-                    # Create text layer
-                    try:
-                        font = ImageFont.truetype(layer.get('font', 'Arial'), layer['size'])
-                    except OSError:
-                        font = ImageFont.load_default()
-                    
-                    draw = ImageDraw.Draw(output)
-                    draw.text(
-                        (layer['position']['x'], layer['position']['y']),
-                        layer['text'],
-                        font=font,
-                        fill=layer.get('color', (0, 0, 0))
-                    )
-                elif layer['type'] == 'image' and 'processed_content' in layer:
-                    # Place processed image
-                    if isinstance(layer['processed_content'], dict) and 'data' in layer['processed_content']:
-                        img_data = base64.b64decode(layer['processed_content']['data'])
-                        img = Image.open(BytesIO(img_data))
-                        output.paste(img, (layer['bounds']['x'], layer['bounds']['y']))
+            if bounded:
+                for done, (_, encoder, target_size, output_path) in enumerate(pending, 1):
+                    stats[output_path] = self._render_bounded(prepared, target_size, output_path, budget, encoder)
+                    if progress:
+                        progress(done / len(pending))
+            else:
+                workers = min(len(pending), current_app.config.get('EXPORT_WORKERS', os.cpu_count() or 1)) or 1
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = {
+                        executor.submit(self._render_export, prepared, revisions, focus_id, target_size, output_path, encoder): output_path
+                        for _, encoder, target_size, output_path in pending
+                    }
+                    for done, future in enumerate(as_completed(futures), 1):
+                        stats[futures[future]] = future.result()
+                        if progress:
+                            progress(done / len(futures))
             
-            # Save the output
-            output.save(output_path)
-            return {'success': True, 'path': output_path}
+            self.exports.evict(keep=[output_path for _, _, _, output_path in jobs])
+            return {'success': True, 'exports': self._export_entries(jobs, stats)}
         except Exception as e:
-            return {'success': False, 'message': str(e)} 
\ No newline at end of file
+            return {'success': False, 'message': str(e)}
+    
+    def _render_state(self):
+        """Hash the document's content and the state of its visible layers in paint order."""
+        sha = hashlib.sha256()
+        document = self._document
+        if document and os.path.exists(document):
+            sha.update(ParseCache.file_key(document).encode())
+        else:
+            sha.update(str(document).encode())
+        visible = [layer for layer in self._layers.values() if layer['visible']]
+        sha.update(json.dumps(visible, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+    
+    @staticmethod
+    def render_key(state, target_size, encoding, renderer='memory'):
+        """Key of an export rendered from ``state`` at ``target_size`` with ``encoding``.
+        
+        ``encoding`` is an ``Encoder.key`` and ``renderer`` names the render
+        path (``memory`` or the bounded ``strips``), which writes its own PNG
+        stream and feeds encoders a different pixel layout. Anything that
+        changes the bytes changes the key, so equal keys produce
+        byte-identical files and the key serves as the export's strong ETag.
+        """
+        width, height = target_size
+        return hashlib.sha256(f'{state}:{width}x{height}:{encoding}:{renderer}'.encode()).hexdigest()[:32]
+    
+    @staticmethod
+    def _export_entries(jobs, stats):
+        entries = []
+        for name, encoder, _, output_path in jobs:
+            seconds, size = stats[output_path]
+            entries.append({
+                'size': name,
+                'format': encoder.name,
+                'options': encoder.options,
+                'path': output_path,
+                'url': f'/exports/{os.path.basename(output_path)}',
+                'etag': export_key(os.path.basename(output_path)),
+                'bytes': size,
+                # Exports served from the cache were not encoded by this call
+                'encode_ms': round(seconds * 1000, 3) if seconds is not None else None,
+                'cached': seconds is None
+            })
+        return entries
+    
+    def _prepare_export_layers(self):
+        """Decode layer images and render text once for all export targets.
+        
+        Text is rendered here into RGBA patches so the render workers only
+        paste images and never share a FreeType face between threads. Items
+        are cached per layer revision, so unchanged layers cost nothing.
+        
+        Returns:
+            list: ``PaintItem``s in paint order
+        """
+        cache = self.session.render_cache
+        cache.forget(self._layers.keys())
+        prepared = []
+        for layer in self._layers.values():
+            if not layer['visible']:
+                continue
+            revision = self.session.layer_revisions.get(layer['id'], 0)
+            prepared.extend(cache.prepared(layer['id'], revision, lambda: self._prepare_layer(layer)))
+        return prepared
+    
+    def _estimate_export_bytes(self, target_sizes):
+        """Rough peak memory of an in-memory export at ``target_sizes``."""
+        layers = sum(
+            4 * layer['bounds']['width'] * layer['bounds']['height']
+            for layer in self._layers.values() if layer['visible']
+        )
+        return layers + sum(COMPOSITE_BYTES_PER_PIXEL * width * height for width, height in target_sizes)
+    
+    def _prepare_bounded_layers(self, budget):
+        """Prepare layers one at a time into memory-mapped arrays.
+        
+        Each layer's decoded image is dropped as soon as it has been spilled,
+        so at most one full-resolution layer is held in memory at a time.
+        """
+        prepared = []
+        for layer in self._layers.values():
+            if not layer['visible']:
+                continue
+            prepared.extend(self._prepare_layer(layer, budget.allocate))
+            if self._rasterizer is not None:
+                self._rasterizer.evict(layer['id'])
+        return prepared
+    
+    def _prepare_layer(self, layer, allocate=None):
+        """Build the paint items of a single layer."""
+        if layer['type'] == 'text' and 'text' in layer:
+            font, _ = load_font(layer.get('font', 'Arial'), layer.get('size', 12))
+            position = layer.get('position', layer['bounds'])
+            text = layer.get('wrapped_text', layer['text'])
+            patch, offset = self._render_text_patch(text, font, layer.get('color', (0, 0, 0)))
+            if patch is not None:
+                return [self._paint_item(layer, (position['x'] + offset[0], position['y'] + offset[1]), patch, allocate)]
+        elif layer['type'] == 'image':
+            if 'processed_content' in layer:
+                img = self.blobs.load_content(layer['processed_content'])
+            elif self._rasterizer is not None and layer.get('has_pixels'):
+                # Untouched layers keep their original document pixels
+                img = self._rasterizer.get_image(layer['id'])
+            else:
+                img = None
+            if img is not None:
+                return [self._paint_item(layer, (layer['bounds']['x'], layer['bounds']['y']), img, allocate)]
+        return []
+    
+    def _paint_item(self, layer, position, image, allocate=None):
+        """Wrap a layer's image in a ``PaintItem`` carrying its mask, opacity and blend mode."""
+        return make_item(
+            layer['id'], position, image,
+            self._layer_mask(layer, position, image.size),
+            layer.get('opacity', 1.0),
+            layer.get('blend_mode', 'normal'),
+            allocate
+        )
+    
+    def _layer_mask(self, layer, position, size):
+        """Return the layer mask cropped to an image placed at ``position``, if any."""
+        mask_info = layer.get('mask')
+        if not mask_info or self._rasterizer is None:
+            return None
+        mask = self._rasterizer.get_mask(layer['id'])
+        if mask is None:
+            return None
+        # Outside its bounds a mask takes its default color
+        full = Image.new('L', size, mask_info.get('default', 0))
+        full.paste(mask, (mask_info['bounds']['x'] - position[0], mask_info['bounds']['y'] - position[1]))
+        return full
+    
+    @staticmethod
+    def _render_text_patch(text, font, fill):
+        """Render text onto a transparent image cropped to its bounding box."""
+        spacing = LayerManager.text_fitter.spacing
+        with font_lock(font):
+            left, top, right, bottom = ImageDraw.Draw(Image.new('RGBA', (1, 1))).multiline_textbbox((0, 0), text, font=font, spacing=spacing)
+            if right <= left or bottom <= top:
+                return None, (0, 0)
+            patch = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+            ImageDraw.Draw(patch).multiline_text((-left, -top), text, font=font, fill=fill, spacing=spacing)
+        return patch, (left, top)
+    
+    def _render_export(self, prepared, revisions, focus_id, target_size, output_path, encoder):
+        """Composite prepared layers onto a canvas of ``target_size`` and save it.
+        
+        Layers other than ``focus_id`` come from cached background composites
+        when they have not changed since the previous render.
+        
+        Returns:
+            tuple: Encode time in seconds and size of the file in bytes
+        """
+        with metrics.timer('composite'):
+            output = self.session.render_cache.render(prepared, revisions, focus_id, target_size)
+        with _replacing(output_path) as temp_path:
+            return encoder.save_file(output, temp_path)
+    
+    @staticmethod
+    def _render_bounded(prepared, target_size, output_path, budget, encoder):
+        """Composite into a memory-mapped canvas strip by strip and save it."""
+        width, height = target_size
+        output = budget.allocate((height, width, 4))
+        with metrics.timer('composite'):
+            composite_strips(prepared, target_size, output, budget.strip_height(width))
+        with _replacing(output_path) as temp_path:
+            start = time.perf_counter()
+            save_rgbx(output, temp_path, encoder=encoder)
+            seconds, size = time.perf_counter() - start, os.path.getsize(temp_path)
+        encoder.record(seconds, size)
+        return seconds, size
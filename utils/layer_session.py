@@ -0,0 +1,268 @@
+import os
+import json
+import logging
+import uuid
+import tempfile
+import threading
+from collections import OrderedDict
+from utils.document_processor import DocumentProcessor, LayerRasterizer
+from utils.render_cache import LayerRenderCache
+
+logger = logging.getLogger(__name__)
+
+class LayerSession:
+    """Editable layer state for a single project document.
+
+    ``revision`` increases on every change. The ids of recently changed
+    layers are kept in ``changes`` so renderers can tell what is stale.
+    ``epoch`` is a random id renewed whenever the layers are replaced or
+    rebuilt, by ``load`` or by reloading an evicted session; layer revisions
+    only mean something within one epoch, so caches keyed on them must also
+    be keyed on it.
+    """
+
+    # Number of (revision, layer_id) entries kept in the change log
+    MAX_CHANGES = 256
+
+    def __init__(self, key, document=None, layers=None, cache=None, revision=0):
+        self.key = key
+        self.document = document
+        self.layers = layers or {}
+        self.cache = cache
+        self.rasterizer = LayerRasterizer(document, cache) if document else None
+        self.lock = threading.RLock()
+        self.revision = revision
+        self.epoch = uuid.uuid4().hex
+        # Changes before base_revision are unknown: treat everything as changed
+        self.base_revision = revision
+        self.changes = []
+        self.layer_revisions = {}
+        self.render_cache = LayerRenderCache()
+        self._canvas_size = None
+        # Newest layer row change the layers reflect, None if not loaded from rows
+        self.synced_at = None
+
+    def load(self, document, layers, synced_at=None):
+        """Replace the session's document and layers."""
+        with self.lock:
+            self.synced_at = synced_at
+            self.document = document
+            self.layers = {layer['id']: layer for layer in layers}
+            self.rasterizer = LayerRasterizer(document, self.cache)
+            self.revision += 1
+            self.epoch = uuid.uuid4().hex
+            self.base_revision = self.revision
+            self.changes = []
+            self.layer_revisions = {}
+            self.render_cache = LayerRenderCache()
+            self._canvas_size = None
+
+    def mark_changed(self, layer_id):
+        """Record that a layer changed and return the new revision."""
+        with self.lock:
+            self.revision += 1
+            self.layer_revisions[layer_id] = self.revision
+            self.changes.append((self.revision, layer_id))
+            del self.changes[:-self.MAX_CHANGES]
+            if len(self.changes) == self.MAX_CHANGES:
+                self.base_revision = self.changes[0][0] - 1
+            return self.revision
+
+    def changed_since(self, revision):
+        """Return the ids of layers changed after ``revision``, or None if unknown."""
+        with self.lock:
+            # Revisions ahead of this session's come from before it was replaced
+            if revision < self.base_revision or revision > self.revision:
+                return None
+            return {layer_id for rev, layer_id in self.changes if rev > revision}
+
+    @property
+    def canvas_size(self):
+        """Document ``(width, height)``, from the file header or the layer bounds."""
+        if self._canvas_size is None:
+            size = DocumentProcessor.document_size(self.document) if self.document else None
+            if size is None:
+                size = (
+                    max([layer['bounds']['x'] + layer['bounds']['width'] for layer in self.layers.values()] or [1]),
+                    max([layer['bounds']['y'] + layer['bounds']['height'] for layer in self.layers.values()] or [1])
+                )
+            self._canvas_size = size
+        return self._canvas_size
+
+    def to_dict(self):
+        return {
+            'key': self.key,
+            'document': self.document,
+            'revision': self.revision,
+            'epoch': self.epoch,
+            'base_revision': self.base_revision,
+            'changes': self.changes,
+            'layer_revisions': self.layer_revisions,
+            'layers': list(self.layers.values())
+        }
+
+    def snapshot(self):
+        """Return a deep, JSON-ready copy of ``to_dict()``, taken under the lock."""
+        with self.lock:
+            return json.loads(json.dumps(self.to_dict()))
+
+    @classmethod
+    def from_dict(cls, data, cache=None):
+        layers = {layer['id']: layer for layer in data.get('layers', [])}
+        session = cls(data['key'], data.get('document'), layers, cache, data.get('revision', 0))
+        # Snapshots from before the change log was serialized start with an empty one
+        # Older snapshots get a fresh epoch, so they never share cached renders
+        session.epoch = data.get('epoch', session.epoch)
+        session.base_revision = data.get('base_revision', session.revision)
+        session.changes = [tuple(change) for change in data.get('changes', [])]
+        session.layer_revisions = dict(data.get('layer_revisions', {}))
+        return session
+
+class SessionRegistry:
+    """Bounded, LRU working set of layer sessions.
+
+    At most ``max_sessions`` sessions are kept in memory. The least recently
+    used one is serialized to ``storage_folder`` when the limit is exceeded
+    and transparently reloaded the next time it is requested. Sessions
+    fetched with ``pin=True`` are never evicted until they are released, so
+    a request cannot lose edits made to a session that was written out
+    behind its back.
+
+    Job workers render from session snapshots rather than live sessions; they
+    keep the render caches of the ``max_render_caches`` most recently rendered
+    snapshots, so consecutive exports of one session reuse prepared layers and
+    background composites.
+    """
+
+    def __init__(self, storage_folder, max_sessions=32, cache=None, max_render_caches=4):
+        self.storage_folder = storage_folder
+        self.max_sessions = max_sessions
+        self.max_render_caches = max_render_caches
+        self.cache = cache
+        self._sessions = OrderedDict()
+        # Number of holders of each pinned session key
+        self._pins = {}
+        self._render_caches = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.storage_folder, exist_ok=True)
+
+    @classmethod
+    def for_app(cls, app):
+        """Return the registry bound to a Flask app, creating it on first use."""
+        registry = app.extensions.get('layer_sessions')
+        if registry is None:
+            from utils.parse_cache import ParseCache
+            registry = cls(
+                app.config.get('LAYER_SESSION_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'sessions')),
+                app.config.get('LAYER_SESSION_MAX', 32),
+                ParseCache.from_app(app)
+            )
+            app.extensions['layer_sessions'] = registry
+        return registry
+
+    def _session_path(self, key):
+        return os.path.join(self.storage_folder, f'{key}.json')
+
+    def get(self, key, pin=False):
+        """Return the session for ``key``, reloading or creating it as needed.
+
+        With ``pin=True`` the session stays in memory until ``release(key)``
+        is called as many times as it was pinned.
+        """
+        key = str(key)
+        with self._lock:
+            if pin:
+                self._pins[key] = self._pins.get(key, 0) + 1
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                return session
+            session = self._load(key) or LayerSession(key, cache=self.cache)
+            self._sessions[key] = session
+            self._evict()
+            return session
+
+    def release(self, key):
+        """Unpin a session fetched with ``get(key, pin=True)``."""
+        key = str(key)
+        with self._lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+                self._evict()
+
+    def drop(self, key):
+        """Forget a session both in memory and on disk."""
+        key = str(key)
+        with self._lock:
+            self._sessions.pop(key, None)
+            path = self._session_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def render_cache(self, session):
+        """Return this process's render cache for a snapshot of ``session``.
+
+        Snapshots of the same session epoch share a cache: their layer
+        revisions identify the same layer contents.
+        """
+        key = (session.key, session.epoch)
+        with self._lock:
+            cache = self._render_caches.get(key)
+            if cache is None:
+                cache = self._render_caches[key] = LayerRenderCache()
+            self._render_caches.move_to_end(key)
+            while len(self._render_caches) > self.max_render_caches:
+                self._render_caches.popitem(last=False)
+            return cache
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _load(self, key):
+        path = self._session_path(key)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        logger.debug(f"Reloaded layer session {key} from {path}")
+        session = LayerSession.from_dict(data, self.cache)
+        # Other processes may reload the same file and edit it differently
+        session.epoch = uuid.uuid4().hex
+        return session
+
+    def _save(self, session):
+        path = self._session_path(session.key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.storage_folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        for key in list(self._sessions.keys()):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if key in self._pins:
+                continue
+            session = self._sessions[key]
+            # Skip sessions that are in the middle of an edit
+            if not session.lock.acquire(blocking=False):
+                continue
+            try:
+                self._save(session)
+                del self._sessions[key]
+                logger.debug(f"Evicted layer session {key}")
+            finally:
+                session.lock.release()
+
+def release_sessions(exc=None):
+    """Unpin the sessions this app context's LayerManagers pinned. Registered as a teardown."""
+    from flask import current_app, g
+    keys = g.pop('pinned_sessions', ())
+    if keys:
+        registry = SessionRegistry.for_app(current_app)
+        for key in keys:
+            registry.release(key)
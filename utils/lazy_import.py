@@ -0,0 +1,43 @@
+import importlib
+import threading
+
+class LazyModule:
+    """Stand-in for a module that is only imported on first attribute access.
+
+    NumPy, OpenCV, psd-tools and Pillow together take a large share of startup time.
+    Modules that use them bind the name to a ``LazyModule`` instead, so that
+    importing the app, running CLI commands or booting a web worker that never
+    touches pixels does not pay for them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Import the module now and return it."""
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+def lazy_import(name):
+    """Return a ``LazyModule`` for ``name``."""
+    return LazyModule(name)
+
+# Imaging modules imported up front by ``preload`` before workers fork
+HEAVY_MODULES = ('numpy', 'cv2', 'psd_tools', 'PIL.Image', 'PIL.ImageDraw', 'PIL.ImageFont')
+
+def preload(modules=HEAVY_MODULES):
+    """Import heavy modules eagerly, e.g. in a pre-forking server's master process."""
+    for name in modules:
+        importlib.import_module(name)
@@ -0,0 +1,106 @@
+import os
+import zlib
+import struct
+import tempfile
+import resource
+from utils.lazy_import import lazy_import
+from utils.encoders import Encoder
+
+Image = lazy_import('PIL.Image')
+np = lazy_import('numpy')
+
+# Rough bytes per canvas pixel while compositing: float32 RGBA planes plus temporaries
+COMPOSITE_BYTES_PER_PIXEL = 48
+
+class MemoryBudget:
+    """Resident memory ceiling for one render job.
+
+    With a ``limit`` (bytes) set, renders whose estimated footprint does not
+    fit under it switch to a bounded mode: layer pixels are spilled to
+    memory-mapped files in ``spill_folder`` and the output is composited in
+    horizontal strips sized to the remaining budget. Such renders run at
+    disk speed instead of getting the worker OOM-killed. A limit of 0 means
+    unlimited.
+    """
+
+    def __init__(self, limit=0, spill_folder=None):
+        self.limit = limit or 0
+        self.spill_folder = spill_folder or tempfile.gettempdir()
+        os.makedirs(self.spill_folder, exist_ok=True)
+
+    @classmethod
+    def from_app(cls, app):
+        """Build the budget configured for a Flask app."""
+        return cls(
+            app.config.get('JOB_MEMORY_LIMIT', 0),
+            app.config.get('SPILL_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'spill'))
+        )
+
+    @staticmethod
+    def rss():
+        """Current resident set size of this process in bytes."""
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            # Peak rather than current RSS, but good enough where /proc is missing
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def fits(self, nbytes):
+        """Whether ``nbytes`` more can be allocated without passing the limit."""
+        return not self.limit or self.rss() + nbytes <= self.limit
+
+    def allocate(self, shape, dtype='uint8'):
+        """Return a zero-filled array, memory-mapped to disk when a limit is set."""
+        if not self.limit or not all(shape):
+            return np.zeros(shape, dtype)
+        fd, path = tempfile.mkstemp(dir=self.spill_folder, suffix='.spill')
+        os.close(fd)
+        try:
+            return np.memmap(path, dtype, 'w+', shape=shape)
+        finally:
+            # The mapping outlives the directory entry; space is freed with the array
+            os.remove(path)
+
+    def strip_height(self, width, minimum=16):
+        """Rows per compositing strip that fit in half the remaining budget."""
+        if not self.limit:
+            return 1024
+        available = max(self.limit - self.rss(), 0) // 2
+        return max(minimum, available // (max(width, 1) * COMPOSITE_BYTES_PER_PIXEL))
+
+def save_rgbx(array, path, rows=256, encoder=None):
+    """Save an ``(height, width, 4)`` RGBX uint8 array, which may be memory-mapped.
+
+    PNGs are encoded a few rows at a time at the encoder's zlib level (its
+    ``optimize`` pass needs the whole image and is skipped); other formats
+    are saved from a PIL image that maps the array's memory instead of
+    copying it. Without an ``encoder`` the format follows the extension.
+    """
+    if encoder is None:
+        encoder = Encoder.from_spec(os.path.splitext(path)[1].lstrip('.') or 'png')
+    height, width = array.shape[:2]
+    if encoder.name != 'png':
+        # JPEG takes RGBX directly, everything else gets an opaque alpha channel
+        mode = 'RGBX' if encoder.name == 'jpg' else 'RGBA'
+        image = Image.frombuffer(mode, (width, height), array, 'raw', mode, 0, 1)
+        encoder.save(image, path)
+        return path
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    compressor = zlib.compressobj(encoder.options['compress_level'])
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        for top in range(0, height, rows):
+            strip = np.asarray(array[top:top + rows, :, :3])
+            # Filter type 0 (none) before every scanline
+            scanlines = np.concatenate([np.zeros((strip.shape[0], 1), np.uint8), strip.reshape(strip.shape[0], -1)], axis=1)
+            data = compressor.compress(scanlines.tobytes())
+            if data:
+                f.write(chunk(b'IDAT', data))
+        f.write(chunk(b'IDAT', compressor.flush()))
+        f.write(chunk(b'IEND', b''))
+    return path
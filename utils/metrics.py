@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the stage latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class MetricsRegistry:
+    """In-process counters, gauges and histograms rendered in Prometheus text format.
+
+    Metrics are identified by name plus a sorted tuple of label pairs. Job
+    worker processes ``dump`` their registry to a shared folder, and the web
+    process merges those snapshots into its own when rendering, so ``/metrics``
+    covers work done outside the request path as well.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        self._dumped_at = 0.0
+
+    def reset(self):
+        """Forget all recorded values, e.g. in a freshly forked worker."""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+        self._dumped_at = 0.0
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter."""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, delta=0, value=None, **labels):
+        """Move a gauge by ``delta``, or set it to ``value``."""
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value if value is not None else self._gauges.get(key, 0) + delta
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram."""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, stage, name='pipeline_stage_seconds', **labels):
+        """Time a block into the stage histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, stage=stage, **labels)
+
+    def cache(self, cache, hit):
+        """Count a cache lookup."""
+        self.inc('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+    def snapshot(self):
+        """Return the registry's state as JSON-serializable data."""
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self._gauges.items()],
+                'histograms': [
+                    [name, list(labels), {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']}]
+                    for (name, labels), h in self._histograms.items()
+                ]
+            }
+
+    def dump(self, folder):
+        """Write this process's snapshot to ``folder`` for other processes to merge."""
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, os.path.join(folder, f'{os.getpid()}.json'))
+        self._dumped_at = time.monotonic()
+
+    def dump_every(self, folder, interval):
+        """``dump`` unless this process already did so in the last ``interval`` seconds."""
+        if time.monotonic() - self._dumped_at >= interval:
+            self.dump(folder)
+
+    @staticmethod
+    def load_snapshots(folder, exclude_pid=None):
+        """Read the snapshots dumped by other processes.
+
+        Snapshots left behind by processes that have exited are deleted, so
+        the gauges of dead workers stop counting.
+        """
+        snapshots = []
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return snapshots
+        for filename in names:
+            if not filename.endswith('.json') or filename == f'{exclude_pid}.json':
+                continue
+            pid = filename[:-len('.json')]
+            if pid.isdigit() and not _process_exists(int(pid)):
+                try:
+                    os.remove(os.path.join(folder, filename))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(folder, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self, snapshots=(), extra_counters=(), extra_gauges=()):
+        """Render this registry merged with ``snapshots`` in Prometheus text format.
+
+        Args:
+            snapshots (list): Snapshots of other processes, see ``load_snapshots``
+            extra_counters (list): ``(name, labels, value)`` read at scrape time
+            extra_gauges (list): ``(name, labels, value)`` read at scrape time
+        """
+        counters, gauges, histograms = {}, {}, {}
+        for snapshot in [self.snapshot(), *snapshots]:
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot.get('gauges', []):
+                key = (name, tuple(tuple(pair) for pair in labels))
+                gauges[key] = gauges.get(key, 0) + value
+            for name, labels, histogram in snapshot.get('histograms', []):
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged = histograms.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+                merged['sum'] += histogram['sum']
+                merged['count'] += histogram['count']
+        for name, labels, value in extra_counters:
+            key = self._key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in extra_gauges:
+            gauges[self._key(name, labels)] = value
+
+        lines = []
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, _ in values}):
+                self._header(lines, name, kind)
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        for name in sorted({name for name, _ in histograms}):
+            self._header(lines, name, 'histogram')
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", _number(bound)),))} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(histogram["sum"])}')
+                lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append(f'# HELP {name} {self._help[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Alive, but owned by another user
+        return True
+    return True
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Process-wide registry used by the instrumented modules
+metrics = MetricsRegistry()
+metrics.describe('pipeline_stage_seconds', 'Time spent in each document pipeline stage.')
+metrics.describe('cache_requests_total', 'Cache lookups by cache and result.')
+metrics.describe('jobs_in_flight', 'Background jobs currently running in this process.')
+metrics.describe('job_seconds', 'Background job run time.')
+metrics.describe('jobs_total', 'Background jobs run, by outcome.')
+metrics.describe('http_request_seconds', 'HTTP request latency by endpoint.')
+metrics.describe('http_requests_in_flight', 'HTTP requests being handled by this process.')
+metrics.describe('jobs_queued', 'Jobs in the queue by status.')
@@ -0,0 +1,73 @@
+import sys
+import concurrent.futures
+from flask import current_app, has_app_context
+
+def cooperative():
+    """Whether this process serves requests on gevent greenlets.
+
+    The async gunicorn worker (``utils.gevent_worker``) monkey-patches
+    sockets before the app is imported, so one OS thread carries every open
+    connection. CPU-bound work must then leave that thread, or it stalls
+    all of them.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+def _in_app_context(app, func):
+    def call(*args, **kwargs):
+        if app is None:
+            return func(*args, **kwargs)
+        with app.app_context():
+            return func(*args, **kwargs)
+    return call
+
+def offload(func, *args, **kwargs):
+    """Run CPU-bound ``func`` off the event loop and return its result.
+
+    Under gevent the call runs on the hub's pool of native threads while
+    the calling greenlet yields, so other connections keep being served;
+    the app context, if any, is carried over. Under sync or threaded
+    workers each request already has its own thread and ``func`` is simply
+    called.
+    """
+    if not cooperative():
+        return func(*args, **kwargs)
+    import gevent
+    app = current_app._get_current_object() if has_app_context() else None
+    return gevent.get_hub().threadpool.apply(_in_app_context(app, func), args, kwargs)
+
+class _CooperativeExecutor:
+    """The part of the executor interface used here, over gevent's native-thread pool.
+
+    ``submit`` returns a gevent ``AsyncResult``, whose ``result()`` yields
+    to other greenlets while the task runs.
+    """
+
+    def __init__(self, max_workers):
+        from gevent.threadpool import ThreadPool
+        self._pool = ThreadPool(max_workers)
+
+    def submit(self, func, *args, **kwargs):
+        return self._pool.spawn(func, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        if wait:
+            self._pool.join()
+        self._pool.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+def thread_pool(max_workers):
+    """Return an executor for CPU-bound tasks whose results a request waits on in order.
+
+    Waiting on a ``concurrent.futures`` future blocks the OS thread, which
+    in async mode is every connection's thread; the cooperative executor
+    is used there instead.
+    """
+    if cooperative():
+        return _CooperativeExecutor(max_workers)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
@@ -0,0 +1,212 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from utils.encoders import INTERMEDIATE_COMPRESS_LEVEL
+from utils.lazy_import import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layer metadata produced by DocumentProcessor changes shape
+PARSER_VERSION = '3'
+
+class ParseCache:
+    """Disk-backed cache of parsed documents, keyed by content hash.
+
+    Each entry is a directory named after the file's SHA-256 and the parser
+    version. It holds ``layers.json`` with the layer metadata,
+    ``thumbnails.json`` with the document's thumbnail pyramid and one PNG per
+    rasterized layer. Entries are evicted least-recently-used first once the
+    cache grows past ``max_bytes``.
+
+    Writes keep a running total of the cache size instead of walking the
+    folder each time. The folder is only scanned when that total passes
+    ``max_bytes``, or when the last scan is older than ``RESCAN_SECONDS``,
+    which picks up what other processes wrote. Eviction then frees a tenth
+    of ``max_bytes`` beyond the limit, so scans stay rare while the cache is
+    full.
+    """
+
+    RESCAN_SECONDS = 60
+
+    _hash_memo = {}
+    _hash_lock = threading.Lock()
+
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Bytes on disk at the last scan plus this process's writes since, None before the first scan
+        self._total = None
+        self._scan_above = max_bytes
+        self._scanned_at = 0.0
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_app(cls, app):
+        """Build the cache configured for a Flask app."""
+        return cls(
+            app.config.get('PARSE_CACHE_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'cache')),
+            app.config.get('PARSE_CACHE_MAX_BYTES', 1024 * 1024 * 1024)
+        )
+
+    @classmethod
+    def file_key(cls, filepath):
+        """Return the cache key for a file: its SHA-256 plus the parser version.
+
+        Hashes are memoized on (path, size, mtime) so an unchanged file is
+        only read once per process.
+        """
+        stat = os.stat(filepath)
+        memo_key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        with cls._hash_lock:
+            digest = cls._hash_memo.get(memo_key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            with cls._hash_lock:
+                cls._hash_memo[memo_key] = digest
+        return f'{digest}-v{PARSER_VERSION}'
+
+    @classmethod
+    def remember_hash(cls, filepath, digest):
+        """Record a SHA-256 already computed elsewhere, e.g. while uploading."""
+        stat = os.stat(filepath)
+        with cls._hash_lock:
+            cls._hash_memo[(os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)] = digest
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def _touch(self, key):
+        try:
+            os.utime(self._entry_dir(key), None)
+        except OSError:
+            pass
+
+    def _write_atomic(self, path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            size = os.path.getsize(tmp_path)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._grew(size - replaced)
+
+    def _grew(self, delta):
+        """Account a write of ``delta`` bytes, evicting only once the cache may be too big."""
+        with self._lock:
+            if self._total is not None:
+                self._total += delta
+            scan = (
+                self._total is None or self._total > self._scan_above
+                or time.monotonic() - self._scanned_at > self.RESCAN_SECONDS
+            )
+        if scan:
+            self.evict()
+
+    def get_layers(self, key):
+        """Return cached layer metadata, or None on a miss."""
+        path = os.path.join(self._entry_dir(key), 'layers.json')
+        try:
+            with open(path, 'r') as f:
+                layers = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._touch(key)
+        return layers
+
+    def put_layers(self, key, layers):
+        """Store layer metadata for a parsed document."""
+        data = json.dumps(layers).encode('utf-8')
+        self._write_atomic(os.path.join(self._entry_dir(key), 'layers.json'), lambda f: f.write(data))
+
+    def get_thumbnails(self, key):
+        """Return the document's thumbnail pyramid, ``{size: blob_id}``, or None on a miss."""
+        path = os.path.join(self._entry_dir(key), 'thumbnails.json')
+        try:
+            with open(path, 'r') as f:
+                pyramid = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._touch(key)
+        return pyramid
+
+    def put_thumbnails(self, key, pyramid):
+        """Store the document's thumbnail pyramid."""
+        data = json.dumps(pyramid).encode('utf-8')
+        self._write_atomic(os.path.join(self._entry_dir(key), 'thumbnails.json'), lambda f: f.write(data))
+
+    def get_bitmap(self, key, layer_id):
+        """Return a cached rasterized layer as a PIL image, or None on a miss."""
+        path = os.path.join(self._entry_dir(key), f'{layer_id}.png')
+        try:
+            with Image.open(path) as img:
+                img.load()
+                image = img.copy()
+        except OSError:
+            return None
+        self._touch(key)
+        return image
+
+    def put_bitmap(self, key, layer_id, image):
+        """Store a rasterized layer."""
+        path = os.path.join(self._entry_dir(key), f'{layer_id}.png')
+        self._write_atomic(path, lambda f: image.save(f, format='PNG', compress_level=INTERMEDIATE_COMPRESS_LEVEL))
+
+    def size(self):
+        """Return the total size of the cache in bytes."""
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return entries
+        for name in names:
+            entry_dir = os.path.join(self.root, name)
+            if not os.path.isdir(entry_dir):
+                continue
+            size = 0
+            for dirpath, _, filenames in os.walk(entry_dir):
+                for filename in filenames:
+                    try:
+                        size += os.path.getsize(os.path.join(dirpath, filename))
+                    except OSError:
+                        pass
+            entries.append((os.path.getmtime(entry_dir), entry_dir, size))
+        return entries
+
+    def evict(self):
+        """Remove least-recently-used entries until the cache fits ``max_bytes``."""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, _, size in entries)
+            slack = self.max_bytes // 10
+            # Never evict the most recently used entry, it is being written
+            for _, entry_dir, size in entries[:-1]:
+                if total <= self.max_bytes - slack:
+                    break
+                logger.debug(f"Evicting parse cache entry {entry_dir}")
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+            self._total = total
+            # Still too big when the newest entry alone is: wait for another slack's worth of writes
+            self._scan_above = self.max_bytes if total <= self.max_bytes else total + slack
+            self._scanned_at = time.monotonic()
@@ -0,0 +1,194 @@
+import math
+import threading
+from collections import OrderedDict
+from utils.compositor import Compositor, item_rect, scale_item
+from utils.metrics import metrics
+from utils.lazy_import import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+class _PreviewState:
+    """What a session looked like when its tiles were rendered."""
+
+    # Zoom levels below 1 whose scaled paint items are kept
+    MAX_ZOOMS = 4
+
+    def __init__(self, epoch, revision, prepared, previous=None):
+        self.epoch = epoch
+        self.revision = revision
+        self.prepared = prepared
+        # Canvas rectangle covered by each layer: layer_id -> [(l, t, r, b), ...]
+        self.rects = {}
+        for item in prepared:
+            self.rects.setdefault(item.layer_id, []).append(item_rect(item))
+        # zoom -> {id(item): (item, scaled item)}, starting from the previous
+        # state's so layers that did not change are not scaled again
+        self._scaled = OrderedDict()
+        self._lock = threading.Lock()
+        if previous is not None:
+            current = {id(item): item for item in prepared}
+            with previous._lock:
+                for zoom, scaled in previous._scaled.items():
+                    self._scaled[zoom] = {key: entry for key, entry in scaled.items() if current.get(key) is entry[0]}
+
+    def scaled_items(self, zoom):
+        """Return the paint items resized to ``zoom``, in paint order."""
+        with self._lock:
+            known = self._scaled.get(zoom, {})
+            scaled = {}
+            for item in self.prepared:
+                entry = known.get(id(item))
+                # The original is kept in the entry, so an id is never reused while it is cached
+                scaled[id(item)] = entry if entry is not None and entry[0] is item else (item, scale_item(item, zoom))
+            self._scaled[zoom] = scaled
+            self._scaled.move_to_end(zoom)
+            while len(self._scaled) > self.MAX_ZOOMS:
+                self._scaled.popitem(last=False)
+        return [scaled[id(item)][1] for item in self.prepared]
+
+class PreviewRenderer:
+    """Render the editor preview as fixed-size tiles at any zoom level.
+
+    Tiles are cached per (session, zoom, column, row) together with the
+    session epoch and revision they were drawn at. When the session moves
+    on, only tiles that intersect a changed layer, before or after the
+    change, are dropped; the rest are carried over to the new revision
+    untouched. A new epoch, e.g. after another document was uploaded into
+    the session, drops all of the session's tiles.
+
+    Below zoom 1 tiles are composited at output resolution from layers
+    scaled down once per zoom level, so a zoomed-out tile costs no more
+    than a tile at zoom 1.
+    """
+
+    def __init__(self, tile_size=256, max_tiles=2048):
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+        self._states = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_app(cls, app):
+        """Return the preview renderer bound to a Flask app, creating it on first use."""
+        renderer = app.extensions.get('preview_renderer')
+        if renderer is None:
+            renderer = cls(app.config.get('PREVIEW_TILE_SIZE', 256), app.config.get('PREVIEW_MAX_TILES', 2048))
+            app.extensions['preview_renderer'] = renderer
+        return renderer
+
+    def grid(self, canvas_size, zoom):
+        """Return the number of ``(columns, rows)`` of tiles at ``zoom``."""
+        return (
+            max(1, math.ceil(canvas_size[0] * zoom / self.tile_size)),
+            max(1, math.ceil(canvas_size[1] * zoom / self.tile_size))
+        )
+
+    def _tile_rect(self, zoom, column, row):
+        """Canvas rectangle covered by a tile."""
+        span = self.tile_size / zoom
+        return column * span, row * span, (column + 1) * span, (row + 1) * span
+
+    @staticmethod
+    def _intersects(a, b):
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+    def _sync(self, manager):
+        """Bring the cached state of a session up to its current revision."""
+        session = manager.session
+        with session.lock:
+            revision, epoch = session.revision, session.epoch
+            state = self._states.get(session.key)
+            if state is not None and state.epoch != epoch:
+                # Revisions of another document or rebuilt session say nothing about this one
+                state = None
+            if state is not None and state.revision == revision:
+                return state
+            new_state = _PreviewState(epoch, revision, manager._prepare_export_layers(), state)
+            changed = session.changed_since(state.revision) if state is not None else None
+
+        with self._lock:
+            if changed is None:
+                dirty = None
+            else:
+                dirty = []
+                for layer_id in changed:
+                    dirty.extend(state.rects.get(layer_id, []))
+                    dirty.extend(new_state.rects.get(layer_id, []))
+            for key in [k for k in self._tiles if k[0] == session.key]:
+                if dirty is None or any(self._intersects(self._tile_rect(*key[1:]), rect) for rect in dirty):
+                    del self._tiles[key]
+            self._states[session.key] = new_state
+        return new_state
+
+    def dirty_tiles(self, manager, zoom, since, epoch=None):
+        """List ``(column, row)`` tiles that changed after revision ``since``.
+
+        Returns None when the whole preview should be refetched: the change
+        log does not reach back that far, or ``since`` belongs to an
+        ``epoch`` other than the session's current one.
+        """
+        state = self._sync(manager)
+        if epoch is not None and epoch != state.epoch:
+            return None
+        changed = manager.session.changed_since(since)
+        if changed is None:
+            return None
+        columns, rows = self.grid(manager.session.canvas_size, zoom)
+        rects = [rect for layer_id in changed for rect in state.rects.get(layer_id, [])]
+        # Layers that moved off their old area are covered by their bounds
+        for layer_id in changed:
+            layer = manager._layers.get(layer_id)
+            if layer is not None:
+                b = layer['bounds']
+                rects.append((b['x'], b['y'], b['x'] + b['width'], b['y'] + b['height']))
+        return [
+            (column, row)
+            for row in range(rows)
+            for column in range(columns)
+            if any(self._intersects(self._tile_rect(zoom, column, row), rect) for rect in rects)
+        ]
+
+    def render_tile(self, manager, zoom, column, row):
+        """Return ``(revision, tile image)`` for one tile of a session's preview."""
+        state = self._sync(manager)
+        key = (manager.session.key, zoom, column, row)
+        with self._lock:
+            tile = self._tiles.get(key)
+            metrics.cache('preview_tile', tile is not None)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                return state.revision, tile
+
+        canvas_w, canvas_h = manager.session.canvas_size
+        left, top, right, bottom = self._tile_rect(zoom, column, row)
+        right, bottom = min(right, canvas_w), min(bottom, canvas_h)
+        tile_size = (
+            max(1, round((right - left) * zoom)),
+            max(1, round((bottom - top) * zoom))
+        )
+        if zoom < 1:
+            items = state.scaled_items(zoom)
+            # Same region on the zoomed canvas, already at tile resolution
+            region = (column * self.tile_size, row * self.tile_size)
+            region += (region[0] + tile_size[0], region[1] + tile_size[1])
+        else:
+            items = state.prepared
+            region = (math.floor(left), math.floor(top), max(math.ceil(right), math.floor(left) + 1), max(math.ceil(bottom), math.floor(top) + 1))
+        with metrics.timer('composite'):
+            compositor = Compositor((region[2] - region[0], region[3] - region[1]))
+            for item in items:
+                if self._intersects(region, item_rect(item)):
+                    compositor.paint(item, (-region[0], -region[1]))
+            canvas = compositor.to_image()
+        tile = canvas.resize(tile_size, Image.Resampling.BILINEAR) if tile_size != canvas.size else canvas
+
+        with self._lock:
+            # Don't cache a tile drawn from a state that was superseded meanwhile
+            current = self._states.get(manager.session.key)
+            if current is not state:
+                return state.revision, tile
+            self._tiles[key] = tile
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return state.revision, tile
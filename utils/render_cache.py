@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+from utils.compositor import Compositor
+from utils.metrics import metrics
+
+class LayerRenderCache:
+    """Per-session cache that lets a single edited layer be re-rendered cheaply.
+
+    Two levels are cached:
+
+    * the prepared paint items of every layer, keyed by the layer's revision,
+      so unchanged layers are never decoded or re-rendered;
+    * for each output size, a composite of everything below the most recently
+      edited ("focus") layer and a transparent composite of everything above
+      it. While only the focus layer keeps changing, a render is one copy and
+      two composites, whatever the number of layers.
+    """
+
+    def __init__(self, max_backgrounds=8):
+        self.max_backgrounds = max_backgrounds
+        self._items = {}
+        self._backgrounds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prepared(self, layer_id, revision, build):
+        """Return the cached paint items of a layer, calling ``build()`` on a miss."""
+        with self._lock:
+            entry = self._items.get(layer_id)
+        hit = entry is not None and entry[0] == revision
+        metrics.cache('layer_items', hit)
+        if hit:
+            return entry[1]
+        items = build()
+        with self._lock:
+            self._items[layer_id] = (revision, items)
+        return items
+
+    def forget(self, layer_ids):
+        """Drop cached items of layers that no longer exist."""
+        with self._lock:
+            for layer_id in set(self._items) - set(layer_ids):
+                del self._items[layer_id]
+
+    def render(self, prepared, revisions, focus_id, target_size):
+        """Composite prepared items onto a white canvas of ``target_size``.
+
+        Args:
+            prepared (list): ``PaintItem``s in paint order
+            revisions (dict): Current revision of each layer id
+            focus_id (str): Layer expected to change next, usually the last edited one
+            target_size (tuple): Output ``(width, height)``
+        """
+        focus_index = [index for index, item in enumerate(prepared) if item.layer_id == focus_id]
+        if focus_id is None or not focus_index:
+            output = Compositor(target_size)
+            output.paint_all(prepared)
+            return output.to_image()
+
+        first, last = focus_index[0], focus_index[-1]
+        below_items, focus_items, above_items = prepared[:first], prepared[first:last + 1], prepared[last + 1:]
+        signature = (
+            focus_id,
+            tuple((item.layer_id, revisions.get(item.layer_id, 0)) for item in below_items),
+            tuple((item.layer_id, revisions.get(item.layer_id, 0)) for item in above_items)
+        )
+        # Blend modes other than normal depend on what is below them, so such
+        # layers above the focus cannot be flattened ahead of time
+        flatten_above = bool(above_items) and all(item.blend_mode == 'normal' for item in above_items)
+
+        with self._lock:
+            background = self._backgrounds.get(target_size)
+            if background is not None:
+                self._backgrounds.move_to_end(target_size)
+        hit = background is not None and background['signature'] == signature
+        metrics.cache('render_background', hit)
+        if not hit:
+            below = Compositor(target_size)
+            below.paint_all(below_items)
+            above = None
+            if flatten_above:
+                above = Compositor(target_size)
+                above.paint_all(above_items)
+            background = {'signature': signature, 'below': below, 'above': above}
+            with self._lock:
+                self._backgrounds[target_size] = background
+                while len(self._backgrounds) > self.max_backgrounds:
+                    self._backgrounds.popitem(last=False)
+
+        output = background['below'].copy()
+        output.paint_all(focus_items)
+        if background['above'] is not None:
+            output.over(background['above'])
+        else:
+            output.paint_all(above_items)
+        return output.to_image()
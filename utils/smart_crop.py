@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+from utils.lazy_import import lazy_import
+from utils.metrics import metrics
+
+Image = lazy_import('PIL.Image')
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+class CropAnalysis:
+    """Edge-energy map of one image at reduced resolution.
+
+    Holds the summed-area table of the map so the energy inside any window
+    can be read in constant time.
+    """
+
+    def __init__(self, energy, scale, image_size):
+        self.energy = energy
+        self.scale = scale
+        self.image_size = image_size
+        # Integral image padded with a zero row/column: I[y, x] = sum(energy[:y, :x])
+        self.integral = np.pad(energy, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+
+    def best_window(self, win_w, win_h):
+        """Return the top-left corner of the ``win_w`` x ``win_h`` window with the most energy."""
+        integral = self.integral
+        h, w = self.energy.shape
+        win_w, win_h = min(win_w, w), min(win_h, h)
+        # Window sums for every valid top-left corner at once
+        sums = (
+            integral[win_h:, win_w:]
+            - integral[:h - win_h + 1, win_w:]
+            - integral[win_h:, :w - win_w + 1]
+            + integral[:h - win_h + 1, :w - win_w + 1]
+        )
+        y, x = np.unravel_index(np.argmax(sums), sums.shape)
+        return int(x), int(y)
+
+class SmartCropper:
+    """Saliency-aware cropping with per-image analysis caching.
+
+    The edge-energy map of an image is computed once, at most
+    ``analysis_size`` pixels on its long side, and kept in a small LRU keyed
+    by a caller-supplied key (e.g. a blob id). Choosing a crop for any
+    aspect ratio is then a vectorized sliding-window search over the map's
+    integral image.
+    """
+
+    def __init__(self, analysis_size=256, cache_size=64):
+        self.analysis_size = analysis_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def analyze(self, image, key=None):
+        """Return the (possibly cached) ``CropAnalysis`` for an image."""
+        if key is not None:
+            with self._lock:
+                analysis = self._cache.get(key)
+                metrics.cache('crop_analysis', analysis is not None)
+                if analysis is not None:
+                    self._cache.move_to_end(key)
+                    return analysis
+
+        thumb = image.copy() if image.mode in ('L', 'LA', 'RGB', 'RGBA') else image.convert('RGBA')
+        thumb.thumbnail((self.analysis_size, self.analysis_size), Image.Resampling.BILINEAR)
+        scale = image.width / thumb.width
+
+        gray = np.asarray(thumb.convert('L'), dtype=np.float32)
+        grad_x = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+        grad_y = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+        energy = cv2.magnitude(grad_x, grad_y)
+        # Spread edge energy so the window favours regions, not single lines
+        energy = cv2.GaussianBlur(energy, (0, 0), sigmaX=max(1.0, thumb.width / 64))
+        if 'A' in thumb.getbands():
+            # Transparent pixels carry no content
+            energy *= np.asarray(thumb.getchannel('A'), dtype=np.float32) / 255.0
+
+        analysis = CropAnalysis(energy.astype(np.float64), scale, image.size)
+        if key is not None:
+            with self._lock:
+                self._cache[key] = analysis
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return analysis
+
+    def crop_box(self, image, target_size, key=None):
+        """Return the ``(left, top, right, bottom)`` crop for ``target_size``'s aspect ratio."""
+        width, height = image.size
+        target_ratio = target_size[0] / target_size[1]
+        # Largest window with the target aspect ratio that fits the image
+        if width / height > target_ratio:
+            crop_w, crop_h = max(1, round(height * target_ratio)), height
+        else:
+            crop_w, crop_h = width, max(1, round(width / target_ratio))
+        if crop_w == width and crop_h == height:
+            return 0, 0, width, height
+
+        analysis = self.analyze(image, key)
+        win_w = max(1, round(crop_w / analysis.scale))
+        win_h = max(1, round(crop_h / analysis.scale))
+        x, y = analysis.best_window(win_w, win_h)
+        left = min(round(x * analysis.scale), width - crop_w)
+        top = min(round(y * analysis.scale), height - crop_h)
+        return left, top, left + crop_w, top + crop_h
+
+    def crop(self, image, target_size, key=None):
+        """Crop an image to ``target_size``'s aspect ratio around its salient region and resize it."""
+        with metrics.timer('smart_crop'):
+            return image.crop(self.crop_box(image, target_size, key)).resize(target_size, Image.Resampling.LANCZOS)
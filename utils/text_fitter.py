@@ -0,0 +1,223 @@
+import math
+import weakref
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from utils.metrics import metrics
+from utils.lazy_import import lazy_import
+
+ImageFont = lazy_import('PIL.ImageFont')
+
+# Maximum number of (font, size) pairs kept loaded
+FONT_CACHE_SIZE = 256
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_path, size):
+    """Load a TrueType font, falling back to Pillow's default font.
+
+    Returns:
+        tuple: ``(font, is_default)``
+    """
+    try:
+        return ImageFont.truetype(font_path, size), False
+    except OSError:
+        try:
+            return ImageFont.load_default(size), True
+        except TypeError:
+            # Pillow < 10.1 only has the fixed-size bitmap default font
+            return ImageFont.load_default(), True
+
+_font_locks = weakref.WeakKeyDictionary()
+_font_locks_lock = threading.Lock()
+
+def font_lock(font):
+    """Return the lock guarding a loaded font.
+
+    Cached fonts are shared between threads, but a FreeType face must not
+    be measured or drawn with from two threads at once. Each font gets its
+    own lock, so text in different fonts or sizes is handled in parallel.
+    """
+    with _font_locks_lock:
+        lock = _font_locks.get(font)
+        if lock is None:
+            lock = _font_locks[font] = threading.Lock()
+        return lock
+
+class FontMetrics:
+    """A loaded font with the advance and ink box of every word it has measured.
+
+    Lines are laid out from word and space advances and line counts, so
+    laying out text costs one ``getlength`` and one ``getbbox`` per distinct
+    word instead of re-measuring every line prefix. Kerning across spaces is
+    ignored, which can put the ink box a pixel or so off.
+    """
+
+    # Distinct words remembered per font before the memo starts over
+    MAX_WORDS = 4096
+
+    def __init__(self, font_path, size):
+        self.font, self.is_default = load_font(font_path, size)
+        self.lock = font_lock(self.font)
+        with self.lock:
+            self.space = self.font.getlength(' ')
+            # Pillow moves multiline text down by the bottom of 'A' (plus the spacing) per line
+            self.line_advance = self.font.getbbox('A')[3]
+        self._words = {}
+
+    def word(self, word):
+        """Return ``(advance, (left, top, right, bottom))`` of a word, its ink box None when blank."""
+        entry = self._words.get(word)
+        if entry is None:
+            with self.lock:
+                if len(self._words) >= self.MAX_WORDS:
+                    self._words.clear()
+                bbox = self.font.getbbox(word) if word.strip() else None
+                if bbox is not None and (bbox[2] <= bbox[0] or bbox[3] <= bbox[1]):
+                    bbox = None
+                entry = self._words[word] = (self.font.getlength(word), bbox)
+        return entry
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def font_metrics(font_path, size):
+    """Return the cached ``FontMetrics`` of a font at a size."""
+    return FontMetrics(font_path, size)
+
+class TextFitter:
+    """Find the largest font size at which text fits a box.
+
+    Sizes are binary-searched between ``min_size`` and an upper bound
+    estimated from the text's area and longest word. Each candidate is laid
+    out from the word measurements cached in ``font_metrics``, so once a
+    font has seen the words a fit only adds up numbers. The last
+    ``MAX_FITS`` results are kept, so refitting a layer with unchanged text
+    and bounds is a lookup.
+    """
+
+    MAX_FITS = 1024
+
+    def __init__(self, fill_ratio=0.9, min_size=8, spacing=4, wrap=True):
+        self.fill_ratio = fill_ratio
+        self.min_size = min_size
+        self.spacing = spacing
+        self.wrap = wrap
+        self._fits = OrderedDict()
+        self._fits_lock = threading.Lock()
+
+    def wrap_text(self, text, font_info, max_width):
+        """Greedily wrap text into lines no wider than ``max_width``.
+
+        Returns:
+            list: ``(words, width)`` per line, ``width`` being the summed advances
+        """
+        lines = []
+        for paragraph in text.split('\n'):
+            words = paragraph.split(' ')
+            line, width = [words[0]], font_info.word(words[0])[0]
+            for word in words[1:]:
+                advance = font_info.word(word)[0]
+                if self.wrap and width + font_info.space + advance <= max_width:
+                    line.append(word)
+                    width += font_info.space + advance
+                elif self.wrap:
+                    lines.append((line, width))
+                    line, width = [word], advance
+                else:
+                    line.append(word)
+                    width += font_info.space + advance
+            lines.append((line, width))
+        return lines
+
+    def measure(self, lines, font_info):
+        """Return the ink box of wrapped ``lines``, as ``multiline_textbbox`` would at (0, 0)."""
+        left = top = math.inf
+        right = bottom = -math.inf
+        step = font_info.line_advance + self.spacing
+        space, word_box = font_info.space, font_info.word
+        for index, (words, _) in enumerate(lines):
+            y = index * step
+            x = 0
+            for word in words:
+                advance, bbox = word_box(word)
+                if bbox is not None:
+                    if x + bbox[0] < left:
+                        left = x + bbox[0]
+                    if x + bbox[2] > right:
+                        right = x + bbox[2]
+                    if y + bbox[1] < top:
+                        top = y + bbox[1]
+                    if y + bbox[3] > bottom:
+                        bottom = y + bbox[3]
+                x += advance + space
+        if left == math.inf:
+            return (0, 0, 0, 0)
+        return (math.floor(left), top, math.ceil(right), bottom)
+
+    def _upper_bound(self, text, font_path, max_size, max_width, max_height):
+        """Largest size worth trying, from the text's area and longest word at ``max_size``."""
+        font_info = font_metrics(font_path, max_size)
+        words = text.split()
+        if not words:
+            return max_size
+        advances = [font_info.word(word)[0] for word in words]
+        line_height = font_info.line_advance + self.spacing
+        area = (sum(advances) + font_info.space * (len(words) - 1)) * line_height
+        scale = min(
+            max_height / line_height,
+            math.sqrt(max_width * max_height / area) if self.wrap else max_width / (sum(advances) or 1),
+            max_width / (max(advances) or 1)
+        )
+        # Hinting keeps glyph widths from scaling exactly with the size
+        return min(max_size, int(max_size * scale * 1.1) + 1)
+
+    def _layout(self, text, font_path, size, max_width):
+        font_info = font_metrics(font_path, size)
+        lines = self.wrap_text(text, font_info, max_width)
+        bbox = self.measure(lines, font_info)
+        return {
+            'size': size,
+            'font': font_info.font,
+            'is_default': font_info.is_default,
+            'lines': [' '.join(words) for words, _ in lines],
+            'bbox': bbox,
+            'width': bbox[2] - bbox[0],
+            'height': bbox[3] - bbox[1]
+        }
+
+    def fit(self, text, font_path, max_size, box_width, box_height):
+        """Fit text into a box, shrinking from ``max_size`` down to ``min_size``.
+
+        Returns:
+            dict: ``size``, ``font``, ``is_default``, ``lines``, ``bbox``,
+            ``width`` and ``height`` of the chosen layout
+        """
+        key = (text, font_path, max_size, box_width, box_height)
+        with self._fits_lock:
+            layout = self._fits.get(key)
+            if layout is not None:
+                self._fits.move_to_end(key)
+                return dict(layout)
+        max_width = box_width * self.fill_ratio
+        max_height = box_height * self.fill_ratio
+        max_size = max(int(max_size), self.min_size)
+        with metrics.timer('text_fit'):
+            layout = self._search(text, font_path, max_size, max_width, max_height)
+        with self._fits_lock:
+            self._fits[key] = layout
+            while len(self._fits) > self.MAX_FITS:
+                self._fits.popitem(last=False)
+        return dict(layout)
+
+    def _search(self, text, font_path, max_size, max_width, max_height):
+        """Binary-search the largest size whose layout fits ``max_width`` by ``max_height``."""
+        low = self.min_size
+        high = max(self._upper_bound(text, font_path, max_size, max_width, max_height), low)
+        best = None
+        while low <= high:
+            size = (low + high) // 2
+            layout = self._layout(text, font_path, size, max_width)
+            if layout['width'] <= max_width and layout['height'] <= max_height:
+                best = layout
+                low = size + 1
+            else:
+                high = size - 1
+        return best or self._layout(text, font_path, self.min_size, max_width)
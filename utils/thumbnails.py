@@ -0,0 +1,44 @@
+from io import BytesIO
+from utils.metrics import metrics
+from utils.lazy_import import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+# Longest side, in pixels, of each level of a thumbnail pyramid
+THUMBNAIL_SIZES = (64, 256, 1024)
+
+def build_pyramid(image, blobs, sizes=THUMBNAIL_SIZES):
+    """Store copies of ``image`` scaled to fit each of ``sizes``.
+
+    Each level is reduced from the next larger one, so only the largest
+    resize reads the full-resolution pixels. Images smaller than a level
+    are stored at their own size.
+
+    Returns:
+        dict: ``{str(size): blob_id}``, empty for images without pixels
+    """
+    if image is None or not image.width or not image.height:
+        return {}
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')
+    pyramid = {}
+    level = image
+    with metrics.timer('thumbnails'):
+        for size in sorted(sizes, reverse=True):
+            if max(level.size) > size:
+                scale = size / max(level.size)
+                fitted = (max(1, round(level.width * scale)), max(1, round(level.height * scale)))
+                level = level.resize(fitted, Image.LANCZOS, reducing_gap=2.0)
+            buffered = BytesIO()
+            # Thumbnails are sent to browsers over and over, so favour size over encode time
+            level.save(buffered, format='PNG', compress_level=9)
+            pyramid[str(size)] = blobs.put_bytes(buffered.getvalue())
+    return pyramid
+
+def pick_level(pyramid, size):
+    """Blob id of the smallest level at least ``size`` pixels across, else of the largest level."""
+    levels = sorted(pyramid.items(), key=lambda item: int(item[0]))
+    for level, blob_id in levels:
+        if int(level) >= size:
+            return blob_id
+    return levels[-1][1] if levels else None
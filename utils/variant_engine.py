@@ -0,0 +1,353 @@
+import os
+import re
+import io
+import csv
+import copy
+import json
+import zipfile
+import threading
+from collections import deque
+from utils.document_processor import DocumentProcessor
+from utils.layer_manager import LayerManager, EXPORT_SIZES
+from utils.blob_store import BLOB_ID
+from utils.compositor import Compositor
+from utils.metrics import metrics
+from utils.encoders import Encoder, EncoderError
+from utils.offload import thread_pool
+
+# Table column naming the output file of a variant
+NAME_COLUMN = 'variant_name'
+
+class VariantError(Exception):
+    """Raised for substitution tables that do not match the template."""
+
+def read_table(stream, table_format='csv'):
+    """Yield substitution rows from a binary CSV or JSON Lines stream.
+
+    CSV columns and JSONL keys are layer ids or layer names; empty values
+    keep the template's content. ``variant_name`` sets the output name.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if table_format == 'csv':
+        for row in csv.DictReader(text):
+            yield {key: value for key, value in row.items() if key is not None}
+    elif table_format in ('jsonl', 'ndjson'):
+        for number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise VariantError(f'Invalid JSON on line {number}')
+            if not isinstance(row, dict):
+                raise VariantError(f'Line {number} is not an object')
+            yield row
+    else:
+        raise VariantError(f'Unsupported table format: {table_format}')
+
+def _encoders(formats):
+    """Encoders for ``formats``, one per file extension so output names stay unique."""
+    try:
+        encoders = Encoder.from_specs(formats)
+    except EncoderError as e:
+        raise VariantError(str(e))
+    extensions = [encoder.extension for encoder in encoders]
+    if len(set(extensions)) != len(extensions):
+        raise VariantError('Formats must not share a file extension')
+    return encoders
+
+def resolve_columns(layers, columns):
+    """Map table columns to layer ids, rejecting unknown and locked layers.
+
+    Columns name a layer by id, or by name for the first layer carrying it.
+    Only layer metadata is read, so tables can be checked before anything
+    is rendered.
+    """
+    by_id = {layer['id']: layer for layer in layers}
+    names = {}
+    for layer in layers:
+        names.setdefault(layer.get('name'), layer['id'])
+    resolved = {}
+    for column in columns:
+        if column == NAME_COLUMN:
+            continue
+        layer_id = column if column in by_id else names.get(column)
+        if layer_id is None:
+            raise VariantError(f'Layer {column} not found')
+        layer = by_id[layer_id]
+        if layer.get('locked', False):
+            raise VariantError(f'Layer {column} is locked')
+        if layer['type'] not in ('text', 'image'):
+            raise VariantError(f'Layer {column} cannot be substituted')
+        resolved[column] = layer_id
+    return resolved
+
+class VariantEngine:
+    """Render many variants of one template at several sizes.
+
+    The template is prepared once: every layer is decoded and text rendered
+    a single time. The layers a table substitutes are the only ones redrawn
+    per variant; each run of untouched layers between them is composited
+    once per output size and reused by every variant. Text is fitted with
+    the shared ``TextFitter`` and ``load_font`` cache.
+    """
+
+    def __init__(self, manager, workers=None):
+        self.manager = manager
+        self.blobs = manager.blobs
+        self.workers = workers or os.cpu_count() or 1
+        with manager.session.lock:
+            self.layers = [copy.deepcopy(layer) for layer in manager._layers.values()]
+            self.prepared = {layer['id']: manager._prepare_layer(layer) for layer in self.layers if layer['visible']}
+        self._backgrounds = {}
+        self._building = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def targets(cls, sizes):
+        """Resolve size names or ``(width, height)`` pairs to ``[(name, size)]``."""
+        targets = {}
+        for size in sizes:
+            if isinstance(size, str) and size in EXPORT_SIZES:
+                targets[size] = EXPORT_SIZES[size]
+            elif isinstance(size, (list, tuple)) and len(size) == 2:
+                targets[f'{int(size[0])}x{int(size[1])}'] = (int(size[0]), int(size[1]))
+            else:
+                raise VariantError(f'Invalid size: {size}')
+        return list(targets.items())
+
+    def resolve_columns(self, columns):
+        """Map table columns to the template's layer ids, see ``resolve_columns``."""
+        return resolve_columns(self.layers, columns)
+
+    def _segments(self, dynamic_ids):
+        """Split the paint order into static runs and substituted layers."""
+        segments = []
+        for layer in self.layers:
+            if layer['id'] in dynamic_ids:
+                segments.append(('dynamic', layer))
+            elif layer['visible']:
+                if segments and segments[-1][0] == 'static':
+                    segments[-1][1].extend(self.prepared[layer['id']])
+                else:
+                    segments.append(('static', list(self.prepared[layer['id']])))
+        return segments
+
+    def _background(self, segments, dynamic_ids, target_size):
+        """Composite each static run once per output size.
+
+        Runs above a substituted layer are flattened only when all of their
+        layers use the normal blend mode; otherwise they are painted per variant.
+        Each size is composited under its own lock, so rows waiting for one
+        size don't hold up the others.
+        """
+        key = (dynamic_ids, target_size)
+        with self._lock:
+            composites = self._backgrounds.get(key)
+            if composites is not None:
+                return composites
+            building = self._building.setdefault(key, threading.Lock())
+        with building:
+            with self._lock:
+                composites = self._backgrounds.get(key)
+            if composites is not None:
+                return composites
+            composites = []
+            for index, (kind, items) in enumerate(segments):
+                if kind != 'static' or (index > 0 and any(item.blend_mode != 'normal' for item in items)):
+                    composites.append(None)
+                elif index == 0:
+                    base = Compositor(target_size)
+                    base.paint_all(items)
+                    composites.append(base)
+                else:
+                    overlay = Compositor(target_size)
+                    overlay.paint_all(items)
+                    composites.append(overlay)
+            with self._lock:
+                self._backgrounds[key] = composites
+                del self._building[key]
+            return composites
+
+    def _substitute(self, layer, value):
+        """Return the paint items of ``layer`` with ``value`` substituted in."""
+        if not layer['visible']:
+            return []
+        if value is None or value == '':
+            return self.prepared.get(layer['id'], [])
+        layer = copy.deepcopy(layer)
+        if layer['type'] == 'text':
+            layer['text'] = str(value)
+            # Fonts are shared, but each is locked only while it is measured or drawn with
+            LayerManager._adjust_text_layer(layer)
+            return self.manager._prepare_layer(layer)
+
+        if isinstance(value, str) and BLOB_ID.match(value) and self.blobs.exists(value):
+            value = {'blob_id': value}
+        elif isinstance(value, str):
+            value = {'data': value}
+        if not isinstance(value, dict):
+            raise VariantError(f"Invalid image for layer {layer['id']}")
+        if 'blob_id' in value and not (BLOB_ID.match(str(value['blob_id'])) and self.blobs.exists(value['blob_id'])):
+            raise VariantError(f"Unknown blob for layer {layer['id']}")
+        image = self.blobs.load_content(value)
+        if image is None:
+            raise VariantError(f"Invalid image for layer {layer['id']}")
+        bounds = layer['bounds']
+        cropped = DocumentProcessor.smart_crop_image(image, (bounds['width'], bounds['height']), value.get('blob_id'))
+        return [self.manager._paint_item(layer, (bounds['x'], bounds['y']), cropped)]
+
+    def _render_row(self, segments, targets, encoders, substitutions):
+        """Render one variant at every target, returning ``[(size_name, extension, bytes)]``."""
+        dynamic = {}
+        for kind, layer in segments:
+            if kind == 'dynamic':
+                dynamic[layer['id']] = self._substitute(layer, substitutions.get(layer['id']))
+
+        outputs = []
+        for name, target_size in targets:
+            with metrics.timer('composite'):
+                composites = self._background(segments, frozenset(dynamic), target_size)
+                output = None
+                for (kind, value), composite in zip(segments, composites):
+                    if output is None:
+                        output = composite.copy() if composite is not None else Compositor(target_size)
+                        if composite is not None:
+                            continue
+                    if kind == 'dynamic':
+                        output.paint_all(dynamic[value['id']])
+                    elif composite is not None:
+                        output.over(composite)
+                    else:
+                        output.paint_all(value)
+                output = (output or Compositor(target_size)).to_image()
+            for encoder in encoders:
+                outputs.append((name, encoder.extension, encoder.encode(output)))
+        return outputs
+
+    def render(self, rows, sizes, formats=('png',)):
+        """Render every row of a substitution table.
+
+        Rows are rendered on a thread pool but yielded in table order, with a
+        bounded number in flight so arbitrarily long tables use constant memory.
+        A ``variant_name`` already taken by an earlier row gets the row's index
+        appended, so no variant overwrites another.
+
+        Yields:
+            dict: ``{'index', 'name', 'files': [(filename, bytes)]}`` or
+            ``{'index', 'name', 'error'}`` for rows that could not be rendered
+        """
+        targets = self.targets(sizes)
+        encoders = _encoders(formats)
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return
+        columns = self.resolve_columns(first.keys())
+        segments = self._segments(set(columns.values()))
+
+        used = set()
+
+        def unique_name(index, row):
+            name = str(row.get(NAME_COLUMN) or f'variant_{index:05d}')
+            name = re.sub(r'[^\w.-]+', '_', name).strip('._') or f'variant_{index:05d}'
+            while name in used:
+                name = f'{name}_{index:05d}'
+            used.add(name)
+            return name
+
+        def render_row(index, name, row):
+            try:
+                unknown = set(row) - set(columns) - {NAME_COLUMN}
+                if unknown:
+                    raise VariantError(f"Unknown columns: {', '.join(sorted(unknown))}")
+                substitutions = {columns[key]: value for key, value in row.items() if key in columns}
+                files = [
+                    (f'{name}_{size_name}.{fmt}', data)
+                    for size_name, fmt, data in self._render_row(segments, targets, encoders, substitutions)
+                ]
+                return {'index': index, 'name': name, 'files': files}
+            except Exception as e:
+                return {'index': index, 'name': name, 'error': str(e)}
+
+        def numbered():
+            yield 0, first
+            for index, row in enumerate(rows, 1):
+                yield index, row
+
+        with thread_pool(self.workers) as executor:
+            pending = deque()
+            for index, row in numbered():
+                pending.append(executor.submit(render_row, index, unique_name(index, row), row))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def write_directory(self, rows, sizes, formats, directory, progress=None, total=None):
+        """Render a table into ``directory``, returning a manifest of the results."""
+        os.makedirs(directory, exist_ok=True)
+        manifest = []
+        for result in self.render(rows, sizes, formats):
+            entry = {'index': result['index'], 'name': result['name']}
+            if 'error' in result:
+                entry['error'] = result['error']
+            else:
+                entry['files'] = []
+                for filename, data in result['files']:
+                    with open(os.path.join(directory, filename), 'wb') as f:
+                        f.write(data)
+                    entry['files'].append(filename)
+            manifest.append(entry)
+            if progress and total:
+                progress(len(manifest) / total)
+        with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        # Finished directories count towards the export folder's size limit
+        self.manager.exports.evict(keep=[directory])
+        return manifest
+
+    def stream_zip(self, rows, sizes, formats):
+        """Render a table as a ZIP archive, yielding it chunk by chunk.
+
+        Images are stored uncompressed since they are already compressed.
+        A ``manifest.json`` listing every row, including failures, comes last.
+        """
+        buffer = _StreamBuffer()
+        manifest = []
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+            for result in self.render(rows, sizes, formats):
+                entry = {'index': result['index'], 'name': result['name']}
+                if 'error' in result:
+                    entry['error'] = result['error']
+                else:
+                    entry['files'] = [filename for filename, _ in result['files']]
+                    for filename, data in result['files']:
+                        archive.writestr(filename, data)
+                manifest.append(entry)
+                yield buffer.drain()
+            archive.writestr('manifest.json', json.dumps(manifest), zipfile.ZIP_DEFLATED)
+        yield buffer.drain()
+
+class _StreamBuffer(io.RawIOBase):
+    """Write-only, non-seekable sink that hands written bytes to a generator."""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data